@@ -1,17 +1,71 @@
 from flask import Flask
 from dotenv import load_dotenv
+import importlib
 import os
+import threading
 
 load_dotenv()
 
 app = Flask(__name__)
 
 # ルートのインポート
+# PyTorch を使うルートは初回のリクエスト（またはモデルの事前ロード）まで読み込まない
 from routes.index import index
-from routes.upload import upload_file
+from routes.history import history
+from routes.metrics import metrics_endpoint
+
+
+def lazy_view(module_name, view_name):
+    def view(*args, **kwargs):
+        module = importlib.import_module(module_name)
+        return getattr(module, view_name)(*args, **kwargs)
+
+    return view
+
 
 app.add_url_rule("/", "index", index)
-app.add_url_rule("/upload", "upload_file", upload_file, methods=["POST"])
+app.add_url_rule(
+    "/upload",
+    "upload_file",
+    lazy_view("routes.upload", "upload_file"),
+    methods=["POST"],
+)
+app.add_url_rule(
+    "/upload/batch",
+    "upload_batch",
+    lazy_view("routes.upload_batch", "upload_batch"),
+    methods=["POST"],
+)
+app.add_url_rule("/models", "model_status", lazy_view("routes.models", "model_status"))
+app.add_url_rule("/history", "history", history)
+app.add_url_rule("/metrics", "metrics", metrics_endpoint)
+
+
+# 全サイトのモデルをロードしてウォームアップし、同時リクエストをまとめて推論するワーカーを起動する
+def preload_models():
+    from utils.inference_server import inference_server
+    from utils.model_registry import registry
+    from utils.sites import get_sites
+
+    for site in get_sites().values():
+        registry.preload(site.models_and_outputs.keys())
+    inference_server.start()
+
+
+def preload_in_background():
+    try:
+        preload_models()
+    except Exception as e:
+        print(f"モデルの事前ロードでエラーが発生しました: {e}")
+
+
+# PRELOAD_MODELS=sync なら起動時にロードを待つ（既定は background で、ロード中もリクエストを受け付ける）
+if os.getenv("PRELOAD_MODELS", "background") == "sync":
+    preload_models()
+else:
+    threading.Thread(
+        target=preload_in_background, name="preload-models", daemon=True
+    ).start()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5001)
@@ -0,0 +1,84 @@
+import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import glob
+import time
+
+from PIL import Image
+from dotenv import load_dotenv
+from utils.file import frame_timestamp
+from utils.frame_archive import DEFAULT_SHARD_SIZE, FrameArchive
+from utils.sites import get_site
+
+# .envファイルの内容を読み込む
+load_dotenv()
+
+
+# 収集済みのフレーム（1ファイル1フレームの JPEG）をアーカイブのシャードにまとめる
+# 再エンコードはせず、切り出し範囲はサイトのレイアウトから計算してメタデータとして記録する
+def archive_files(archive, input_dir, site, remove=False):
+    names = [lot["name"] for lot in site.lots]
+    paths = sorted(
+        glob.glob(os.path.join(input_dir, "**", "*.jpg"), recursive=True)
+    )
+    added = 0
+    for path in paths:
+        frame = os.path.relpath(path, input_dir)
+        with Image.open(path) as image:
+            width, height = image.size
+        _, stored = archive.add_file(
+            path,
+            frame_timestamp(frame, path),
+            site=site.name,
+            rects=site.layout.rects(names, width, height),
+            source=frame,
+        )
+        added += stored
+        # 索引に記録してから元のファイルを削除する
+        if remove:
+            os.remove(path)
+    return len(paths), added
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="収集済みのフレームを content-addressed なシャード（tar）にまとめる"
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        default=["data/train/raw", "data/train/processed"],
+        help="フレームのディレクトリ（YYYY/MM/DD/frame_HHMMSS.jpg）",
+    )
+    parser.add_argument("--archive", default=None, help="既定は FRAME_ARCHIVE")
+    parser.add_argument(
+        "--site", default=None, help="サイト名（省略時は設定ファイルの最初のサイト）"
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=DEFAULT_SHARD_SIZE // 1024 // 1024,
+        help="1シャードの最大サイズ（MB）",
+    )
+    parser.add_argument(
+        "--remove", action="store_true", help="アーカイブした元のファイルを削除する"
+    )
+    args = parser.parse_args()
+
+    site = get_site(args.site)
+    start = time.perf_counter()
+    shard_size = args.shard_size * 1024 * 1024
+    with FrameArchive(args.archive, shard_size=shard_size) as archive:
+        for input_dir in args.inputs:
+            count, added = archive_files(archive, input_dir, site, remove=args.remove)
+            print(f"{input_dir}: {count}フレーム（新規 {added}、重複 {count - added}）")
+        print(f"アーカイブ {archive.root}: {archive.stats()}")
+    print(f"{time.perf_counter() - start:.1f}秒")
+
+
+if __name__ == "__main__":
+    main()
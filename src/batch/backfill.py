@@ -0,0 +1,238 @@
+import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import glob
+import sqlite3
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from utils.cpu_tuning import tuning
+from utils.file import frame_timestamp
+from utils.frame_archive import FrameArchive, decode_frame, read_frame
+from utils.image import split_image_array
+from utils.layout import Layout
+from utils.model_registry import registry
+from utils.predict import preprocess_array, to_status
+from utils.sites import get_site
+
+
+# 1フレームを読み込み、全駐車場のセグメントを前処理済みテンソル（L x 3 x 224 x 224）にする
+class FrameDataset(Dataset):
+    def __init__(self, root, frames, models_and_outputs, layout):
+        self.root = root
+        self.frames = frames
+        self.models_and_outputs = models_and_outputs
+        self.layout = layout
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, i):
+        frame = self.frames[i]
+        try:
+            with Image.open(os.path.join(self.root, frame)) as image:
+                array = np.array(image.convert("RGB"))
+            segments = split_image_array(
+                array, self.models_and_outputs, self.layout
+            )
+            images = torch.cat(
+                [preprocess_array(segment, "cpu") for segment, _, _ in segments]
+            )
+        except Exception as e:
+            print(f"{frame} を読み込めませんでした: {e}")
+            return None
+        return frame, images
+
+
+# アーカイブ（utils/frame_archive.py）の記録を読み込む
+# 切り出しは記録した範囲（画素）を使い、範囲のない区画はサイトのレイアウトで切り出す
+class ArchiveFrameDataset(FrameDataset):
+    def __init__(self, root, captures, models_and_outputs, layout):
+        super().__init__(root, list(captures), models_and_outputs, layout)
+        self.captures = captures
+
+    def __getitem__(self, i):
+        frame = self.frames[i]
+        capture = self.captures[frame]
+        try:
+            array = decode_frame(read_frame(self.root, capture))
+            height, width = array.shape[:2]
+            lots = []
+            for output_name in self.models_and_outputs.values():
+                name = os.path.splitext(output_name)[0]
+                rect = capture["rects"].get(name)
+                if rect is None:
+                    rect = self.layout.box(name, width, height)
+                lots.append({"name": name, "rect": list(rect)})
+            segments = split_image_array(
+                array, self.models_and_outputs, Layout(lots, units="pixel")
+            )
+            images = torch.cat(
+                [preprocess_array(segment, "cpu") for segment, _, _ in segments]
+            )
+        except Exception as e:
+            print(f"{frame} を読み込めませんでした: {e}")
+            return None
+        return frame, images
+
+
+# 読み込めなかったフレームを除いてバッチにまとめる
+def collate_frames(items):
+    items = [item for item in items if item is not None]
+    if not items:
+        return [], None
+    frames = [frame for frame, _ in items]
+    images = torch.stack([images for _, images in items])
+    return frames, images
+
+
+def open_output(output_path, fresh=False):
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(output_path)
+    if fresh:
+        conn.execute("DROP TABLE IF EXISTS predictions")
+        conn.execute("DROP TABLE IF EXISTS frames")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS predictions (
+            timestamp TEXT NOT NULL,
+            lot TEXT NOT NULL,
+            status TEXT NOT NULL,
+            confidence REAL NOT NULL,
+            frame TEXT NOT NULL,
+            PRIMARY KEY (frame, lot)
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS predictions_lot_timestamp "
+        "ON predictions (lot, timestamp)"
+    )
+    # 処理済みフレームの記録（再実行時はここに記録済みのフレームをスキップする）
+    conn.execute("CREATE TABLE IF NOT EXISTS frames (frame TEXT PRIMARY KEY)")
+    conn.commit()
+    return conn
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="過去のフレームに学習済みモデルを一括適用して占有履歴を再生成する"
+    )
+    parser.add_argument(
+        "--site", default=None, help="サイト名（省略時は設定ファイルの最初のサイト）"
+    )
+    parser.add_argument("--input", default="data/train/processed")
+    parser.add_argument(
+        "--archive",
+        default=None,
+        help="フレームのアーカイブから読み込む（例: data/archive、--input の代わり）",
+    )
+    parser.add_argument("--output", default="data/backfill.sqlite")
+    parser.add_argument(
+        "--batch-size", type=int, default=16, help="1バッチのフレーム数"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="DataLoader のワーカー数"
+    )
+    parser.add_argument(
+        "--fresh", action="store_true", help="既存の結果を破棄して最初からやり直す"
+    )
+    args = parser.parse_args()
+
+    conn = open_output(args.output, fresh=args.fresh)
+    done = {row[0] for row in conn.execute("SELECT frame FROM frames")}
+    site = get_site(args.site)
+    models_and_outputs = site.models_and_outputs
+
+    captures = None
+    if args.archive:
+        # アーカイブの記録は時刻順に並び、シャードを前から順に読むことになる
+        with FrameArchive(args.archive) as archive:
+            captures = {
+                f"archive/{capture['site']}/{capture['timestamp']}": capture
+                for capture in archive.captures(site=site.name)
+            }
+        captures = {
+            frame: capture for frame, capture in captures.items() if frame not in done
+        }
+        frames = list(captures)
+        dataset = ArchiveFrameDataset(
+            args.archive, captures, models_and_outputs, site.layout
+        )
+    else:
+        frames = sorted(
+            os.path.relpath(path, args.input)
+            for path in glob.glob(
+                os.path.join(args.input, "**", "*.jpg"), recursive=True
+            )
+        )
+        frames = [frame for frame in frames if frame not in done]
+        dataset = FrameDataset(args.input, frames, models_and_outputs, site.layout)
+    print(f"{len(frames)}フレームを処理します（処理済み {len(done)}フレーム）")
+
+    registry.warmup = False
+    registry.preload(models_and_outputs.keys())
+    lots = [
+        (model_path, os.path.splitext(output_name)[0])
+        for model_path, output_name in models_and_outputs.items()
+    ]
+
+    loader = DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+        collate_fn=collate_frames,
+    )
+
+    start = time.perf_counter()
+    processed = 0
+    for batch_frames, images in loader:
+        if not batch_frames:
+            continue
+        rows = []
+        # 駐車場ごとに、バッチ内の全フレームのセグメントをまとめて推論する
+        for j, (model_path, lot) in enumerate(lots):
+            model, device = registry.get(model_path)
+            with tuning.inference_context(device):
+                outputs = model(tuning.prepare_input(images[:, j].to(device)))
+            confidences, preds = torch.softmax(outputs.float(), 1).max(1)
+            for frame, pred, confidence in zip(
+                batch_frames, preds.tolist(), confidences.tolist()
+            ):
+                if captures is not None:
+                    timestamp = captures[frame]["timestamp"]
+                else:
+                    timestamp = frame_timestamp(
+                        frame, os.path.join(args.input, frame)
+                    )
+                rows.append((timestamp, lot, to_status(pred), confidence, frame))
+
+        # 結果と処理済みフレームを同じトランザクションで書き込む（ここがチェックポイント）
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)", rows
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO frames VALUES (?)",
+                [(frame,) for frame in batch_frames],
+            )
+        processed += len(batch_frames)
+        seconds = time.perf_counter() - start
+        print(
+            f"{processed}/{len(frames)}フレーム処理済み "
+            f"({processed / seconds:.1f} フレーム/秒)"
+        )
+
+    conn.close()
+    print(f"完了: {processed}フレーム, {time.perf_counter() - start:.1f}秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import io
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+from utils.layout import Layout, decode_file
+
+names = ["takeda_a", "takeda_b", "takeda_c", "takeda_d", "rittai_p", "bottom"]
+
+
+# 従来の分割処理（PIL で開いて crop し、セグメントごとに JPEG で保存）
+def legacy_split(filepath, target_folder):
+    image = Image.open(filepath)
+    width, height = image.size
+    segment_height = height // len(names)
+    paths = []
+    for i, name in enumerate(names):
+        box = (0, i * segment_height, width, (i + 1) * segment_height)
+        segment_path = os.path.join(target_folder, f"{name}.jpg")
+        image.crop(box).save(segment_path)
+        paths.append(segment_path)
+    return paths
+
+
+# 従来の分割後、前処理のために保存したセグメントを読み込み直す
+def legacy_split_and_load(filepath, target_folder):
+    return [
+        np.array(Image.open(path).convert("RGB"))
+        for path in legacy_split(filepath, target_folder)
+    ]
+
+
+# レイアウトでの分割（1回デコードしてビューとして切り出す）
+def layout_split(filepath, layout):
+    image, _ = decode_file(filepath)
+    return layout.crop(image, names)
+
+
+def measure(function, iterations):
+    function()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="レイアウトによる分割と従来の PIL の crop+save を比較する"
+    )
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--layout", default=None, help="レイアウトの設定ファイル")
+    args = parser.parse_args()
+
+    if args.layout:
+        layout = Layout.load(args.layout)
+    else:
+        layout = Layout(
+            [{"name": name, "band": [i, len(names)]} for i, name in enumerate(names)]
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 合成したフレームを JPEG で保存して入力にする
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+        filepath = os.path.join(tmp, "frame.jpg")
+        Image.fromarray(frame).save(filepath, quality=90)
+        target_folder = os.path.join(tmp, "target")
+        os.makedirs(target_folder)
+
+        results = {
+            "legacy crop+save": measure(
+                lambda: legacy_split(filepath, target_folder), args.iterations
+            ),
+            "legacy crop+save+reload": measure(
+                lambda: legacy_split_and_load(filepath, target_folder),
+                args.iterations,
+            ),
+            "layout decode+views": measure(
+                lambda: layout_split(filepath, layout), args.iterations
+            ),
+        }
+
+        with open(filepath, "rb") as f:
+            data = f.read()
+        decoded = np.array(Image.open(io.BytesIO(data)).convert("RGB"))
+        results["layout views only"] = measure(
+            lambda: layout.crop(decoded, names), args.iterations
+        )
+
+    print(f"フレーム {args.width}x{args.height}, {args.iterations}回の平均")
+    for name, milliseconds in results.items():
+        print(f"  {name:<26} {milliseconds:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
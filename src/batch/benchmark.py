@@ -0,0 +1,421 @@
+import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(SRC_DIR)
+
+import argparse
+import io
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import models
+
+# 予測処理の各段階をネットワークや実際のチェックポイントなしで計測するベンチマーク
+# 乱数で初期化した ResNet18 を load_model と同じ .pth 形式で一時フォルダに保存し、
+# 合成したフレームを入力にする。結果は JSON で保存し、基準の結果と比較できる。
+
+LOTS = ["takeda_a", "takeda_b", "takeda_c", "takeda_d", "rittai_p", "bottom"]
+# 新しいプロセスでモデルをロードし、所要時間とメモリ使用量（kB）を JSON で出力する
+# 最初の引数が ensemble なら、ModelEnsemble を作って1回推論してから計測する
+LOAD_MODELS_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from utils.predict import ModelEnsemble, load_model
+imported = time.perf_counter()
+loaded_models = [load_model(model_path)[0] for model_path in sys.argv[2:]]
+if sys.argv[1] == "ensemble":
+    import torch
+    with torch.no_grad():
+        ModelEnsemble(loaded_models)(torch.zeros(len(loaded_models), 3, 224, 224))
+loaded = time.perf_counter()
+memory = {}
+try:
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            if key in ("Rss", "Private_Clean", "Private_Dirty"):
+                memory[key] = int(value.split()[0])
+except OSError:
+    import resource
+    memory["Rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"import_ms": (imported - start) * 1000,
+                  "load_ms": (loaded - imported) * 1000, "memory_kb": memory}))
+"""
+
+# 新しいプロセスで Flask アプリを読み込み、最初のリクエストに応答するまで
+APP_START_SCRIPT = """
+import sys
+sys.argv = sys.argv[:1]
+from app import app
+app.test_client().get("/")
+"""
+
+LOT_ENV = {
+    "takeda_a": "PARKING_LOT_TAKEDA_A",
+    "takeda_b": "PARKING_LOT_TAKEDA_B",
+    "takeda_c": "PARKING_LOT_TAKEDA_C",
+    "takeda_d": "PARKING_LOT_TAKEDA_D",
+    "rittai_p": "PARKING_LOT_RITTAI_P",
+}
+
+
+# Visitory API の代わりに 200 を返すだけのローカルサーバー
+class StubVisitoryHandler(BaseHTTPRequestHandler):
+    requests_received = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        StubVisitoryHandler.requests_received += 1
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubVisitoryHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ベンチマーク用の作業フォルダ（models/, config/, data/）を作る
+def prepare_workspace(workspace, width, height):
+    os.makedirs(os.path.join(workspace, "models"))
+    os.makedirs(os.path.join(workspace, "config"))
+    for folder in ["data/upload", "data/target", "data/audit"]:
+        os.makedirs(os.path.join(workspace, folder))
+    for config_file in ["layout.json", "sites.json"]:
+        shutil.copy(
+            os.path.join(SRC_DIR, "..", "config", config_file),
+            os.path.join(workspace, "config", config_file),
+        )
+
+    torch.manual_seed(0)
+    models_and_outputs = {}
+    for lot in LOTS:
+        model = models.resnet18(weights=None)
+        model.fc = torch.nn.Linear(model.fc.in_features, 3)
+        model_path = f"models/parking_model_{lot}.pth"
+        torch.save(model.state_dict(), os.path.join(workspace, model_path))
+        models_and_outputs[model_path] = f"{lot}.jpg"
+
+    # 同じ重みをメモリマップで読み込む形式でも保存する（models_mmap/ には .pth を置かない）
+    from utils.checkpoint import save_checkpoint
+    from utils.predict import checkpoint_metadata
+
+    os.makedirs(os.path.join(workspace, "models_mmap"))
+    for model_path in models_and_outputs:
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        save_checkpoint(
+            os.path.join(workspace, "models_mmap", f"{name}.safetensors"),
+            torch.load(os.path.join(workspace, model_path), map_location="cpu"),
+            checkpoint_metadata(),
+        )
+
+    frame_path = os.path.join(workspace, "frame.jpg")
+    synthetic_frame(width, height, 0).save(frame_path, quality=90)
+    return models_and_outputs, frame_path
+
+
+def synthetic_frame(width, height, seed):
+    rng = np.random.default_rng(seed)
+    # 単純なノイズではなく、ある程度 JPEG らしく圧縮できるグラデーションにノイズを足す
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    noise = rng.normal(0, 20, (height, width, 3)).astype(np.float32)
+    return Image.fromarray(np.clip(gradient + noise, 0, 255).astype(np.uint8))
+
+
+def measure(function, iterations, warmup=1, setup=None):
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        function()
+    samples = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        "n": len(samples),
+        "mean_ms": statistics.mean(samples),
+        "p50_ms": samples[len(samples) // 2],
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "min_ms": samples[0],
+    }
+
+
+def run_python(script, args=(), env=None):
+    completed = subprocess.run(
+        [sys.executable, "-c", script, *args],
+        env=dict(os.environ, PYTHONPATH=SRC_DIR, **(env or {})),
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return completed.stdout
+
+
+# 新しいプロセスでの起動時間（インタプリタの起動を含む）とメモリ使用量を計測する
+def measure_cold_start(model_paths, runs, ensemble=False):
+    reports = []
+    mode = "ensemble" if ensemble else "load"
+
+    def load():
+        reports.append(json.loads(run_python(LOAD_MODELS_SCRIPT, [mode, *model_paths])))
+
+    stats = measure(load, runs, warmup=0)
+    memory = {
+        key: statistics.median(report["memory_kb"][key] for report in reports) / 1024
+        for key in reports[0]["memory_kb"]
+    }
+    stats.update(
+        {
+            "import_ms": statistics.median(r["import_ms"] for r in reports),
+            "load_ms": statistics.median(r["load_ms"] for r in reports),
+            "rss_mb": memory.get("Rss"),
+            "private_mb": (
+                memory["Private_Clean"] + memory["Private_Dirty"]
+                if "Private_Dirty" in memory
+                else None
+            ),
+            # 書き換えたページ（コピーした重みなど）。メモリマップした重みのページは含まない
+            "private_dirty_mb": memory.get("Private_Dirty"),
+        }
+    )
+    return stats
+
+
+def run(args):
+    workspace = tempfile.mkdtemp(prefix="parking-bench-")
+    cwd = os.getcwd()
+    server = start_stub_server()
+    try:
+        models_and_outputs, frame_path = prepare_workspace(
+            workspace, args.width, args.height
+        )
+        os.chdir(workspace)
+
+        # アプリのモジュールを読み込む前に、ローカルの設定を環境変数に入れる
+        os.environ.update(
+            {
+                "VISITORY_URL": f"http://127.0.0.1:{server.server_port}/",
+                "VISITORY_AUTH": "bench",
+                "UPLOAD_FOLDER": "data/upload",
+                "TARGET_FOLDER": "data/target",
+                "HISTORY_DB": "data/history.sqlite",
+                "LAYOUT_FILE": "config/layout.json",
+                "SITES_FILE": "config/sites.json",
+                "PRELOAD_MODELS": "sync",
+                "VISITORY_STATE_FILE": "",
+                # ホストごとに保存した推論設定は使わず、既定の設定で比べる
+                "CPU_TUNING": "off",
+            }
+        )
+        for lot, name in LOT_ENV.items():
+            os.environ[name] = f"bench-{lot}"
+
+        from utils.cpu_tuning import DEFAULT_SETTINGS
+        from utils.image import split_image
+        from utils.predict import load_model, predict, preprocess_image
+        from utils import visistory_api
+        from utils.visistory_api import run_predictions
+
+        model_path = next(iter(models_and_outputs))
+        stages = {}
+
+        stages["load_model"] = measure(
+            lambda: load_model(model_path), args.iterations
+        )
+        model, device = load_model(model_path)
+
+        segments = split_image(frame_path, "data/target", models_and_outputs)
+        segment_path = segments[0][0]
+        stages["split_image"] = measure(
+            lambda: split_image(frame_path, "data/target", models_and_outputs),
+            args.iterations,
+        )
+        stages["preprocess_image"] = measure(
+            lambda: preprocess_image(segment_path, device), args.iterations
+        )
+        # uint8 のまま縮小・正規化する前処理（CPU_TUNING の fused_preprocess）
+        fused = dict(DEFAULT_SETTINGS, fused_preprocess=True)
+        stages["preprocess_image_fused"] = measure(
+            lambda: preprocess_image(segment_path, device, fused), args.iterations
+        )
+        stages["predict"] = measure(
+            lambda: predict(segment_path, model, device), args.iterations
+        )
+
+        # 毎回全駐車場を送信するよう、前回送信した状態を消してから計測する
+        # （状態が変わらないと2回目以降は送信されず、送信のコストを計測できない）
+        def reset_sent():
+            if visistory_api._visitory_client is not None:
+                visistory_api._visitory_client.reset()
+
+        posts = StubVisitoryHandler.requests_received
+        stages["run_predictions"] = measure(
+            lambda: run_predictions(segments), args.iterations, setup=reset_sent
+        )
+        stages["run_predictions"]["posts"] = (
+            StubVisitoryHandler.requests_received - posts
+        )
+
+        # Flask のテストクライアントで /upload 全体を計測する
+        # （毎回異なる画像を送るキャッシュなしの場合と、同じ画像を送るキャッシュありの場合）
+        sys.argv = sys.argv[:1]
+        from app import app
+
+        client = app.test_client()
+        uploads = {"data": None, "seed": 0}
+
+        def next_upload():
+            uploads["seed"] += 1
+            buffer = io.BytesIO()
+            synthetic_frame(args.width, args.height, uploads["seed"]).save(
+                buffer, format="JPEG", quality=90
+            )
+            uploads["data"] = buffer.getvalue()
+
+        def post_upload():
+            response = client.post(
+                "/upload",
+                data={"file": (io.BytesIO(uploads["data"]), "frame.jpg")},
+                content_type="multipart/form-data",
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"/upload failed: {response.get_json()}")
+
+        stages["upload"] = measure(post_upload, args.iterations, setup=next_upload)
+        stages["upload_cached"] = measure(post_upload, args.iterations)
+
+        # コールドスタート: .pth と .safetensors（メモリマップ）で全モデルをロードする場合、
+        # それぞれ ModelEnsemble で一括推論した後（.pth はパラメータを積み重ねたコピーを含む）、
+        # Flask アプリが起動時にモデルのロードを待つ場合と待たない場合
+        mmap_paths = [
+            os.path.join("models_mmap", os.path.basename(path))
+            for path in models_and_outputs
+        ]
+        for name, paths in [("pth", list(models_and_outputs)), ("mmap", mmap_paths)]:
+            stages[f"cold_start_{name}"] = measure_cold_start(
+                paths, args.cold_start_runs
+            )
+            stages[f"cold_start_{name}_ensemble"] = measure_cold_start(
+                paths, args.cold_start_runs, ensemble=True
+            )
+        for mode in ["sync", "background"]:
+            stages[f"app_start_{mode}"] = measure(
+                lambda: run_python(APP_START_SCRIPT, env={"PRELOAD_MODELS": mode}),
+                args.cold_start_runs,
+                warmup=0,
+            )
+
+        return {
+            "meta": {
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "host": platform.node(),
+                "machine": platform.machine(),
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "torch_threads": torch.get_num_threads(),
+                "cpu_count": os.cpu_count(),
+                "frame": [args.width, args.height],
+                "iterations": args.iterations,
+                "visitory_posts": StubVisitoryHandler.requests_received,
+            },
+            "stages": stages,
+        }
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+# 基準の結果と比較し、tolerance 倍より遅くなった段階を返す
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"{'stage':<20} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    for name, current in results["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None:
+            print(f"{name:<20} {'-':>12} {current['p50_ms']:>10.2f}ms {'-':>8}")
+            continue
+        ratio = current["p50_ms"] / base["p50_ms"] if base["p50_ms"] else float("inf")
+        print(
+            f"{name:<20} {base['p50_ms']:>10.2f}ms {current['p50_ms']:>10.2f}ms "
+            f"{ratio:>7.2f}x"
+        )
+        if ratio > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="予測処理の各段階のベンチマーク")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument(
+        "--cold-start-runs", type=int, default=3, help="新しいプロセスでの起動の計測回数"
+    )
+    parser.add_argument("--output", default="bench/results.json")
+    parser.add_argument("--baseline", default=None, help="比較する基準の結果")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.2,
+        help="基準の p50 のこの倍率を超えたら遅くなったとみなす",
+    )
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    results = run(args)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"結果を保存しました: {output}")
+
+    if baseline_path is None:
+        for name, stats in results["stages"].items():
+            line = f"{name:<20} p50 {stats['p50_ms']:>10.2f}ms"
+            if stats.get("rss_mb") is not None:
+                line += f"  RSS {stats['rss_mb']:.1f}MB"
+            if stats.get("private_mb") is not None:
+                line += f"  private {stats['private_mb']:.1f}MB"
+                line += f" (dirty {stats['private_dirty_mb']:.1f}MB)"
+            print(line)
+        return
+
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"基準より遅くなった段階があります: {regressions}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
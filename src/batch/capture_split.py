@@ -1,9 +1,17 @@
 import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
 import subprocess
 from datetime import datetime
-from PIL import Image
 import shutil  # ファイル移動のためにインポート
 from dotenv import load_dotenv
+from utils.frame_archive import FrameArchive
+from utils.image import split_training_frame
+from utils.layout import decode_file, get_layout
+from utils.sites import get_site
 
 # .envファイルの内容を読み込む
 load_dotenv()
@@ -12,31 +20,19 @@ load_dotenv()
 youtube_url = os.getenv("YOUTUBE_URL")
 
 
-# 分割関数
-def split_image(filepath, target_folder, models_and_outputs):
-    image = Image.open(filepath)
-    width, height = image.size
-    segment_height = height // 6  # 6分割
-    segments = []
-
-    original_filename = os.path.basename(filepath)
-    date_str = (
-        os.path.dirname(filepath).replace("data/train/raw/", "").replace("/", "_")
-    )
-    base_filename = f"{date_str}_{original_filename}"
-
-    for i, (model_name, _) in enumerate(models_and_outputs.items()):
-        box = (0, i * segment_height, width, (i + 1) * segment_height)
-        segment = image.crop(box)
-
-        model_folder = os.path.join(target_folder, model_name)
-        os.makedirs(model_folder, exist_ok=True)
-
-        segment_path = os.path.join(model_folder, base_filename)
-        segment.save(segment_path)
-        segments.append((segment_path, model_name, base_filename))
-
-    return segments
+def archive_frame(filepath, models_and_outputs):
+    layout = get_layout()
+    image, _ = decode_file(filepath)
+    height, width = image.shape[:2]
+    with FrameArchive() as archive:
+        key, stored = archive.add_file(
+            filepath,
+            datetime.now().isoformat(timespec="seconds"),
+            site=get_site().name,
+            rects=layout.rects(models_and_outputs.keys(), width, height),
+        )
+    os.remove(filepath)
+    print(f"フレームをアーカイブしました: {key[:12]}{'' if stored else '（重複）'}")
 
 
 # フレーム取得＆分割処理
@@ -60,8 +56,16 @@ def capture_split(youtube_url, output_folder, target_folder, models_and_outputs)
         subprocess.run(command, shell=True, check=True)
         print(f"フレームが正常に保存されました: {output_path}")
 
+        # FRAME_ARCHIVE を設定した場合は、分割画像を保存せず、
+        # フレームと切り出し範囲をアーカイブに追記して元のファイルを削除する
+        if os.getenv("FRAME_ARCHIVE"):
+            archive_frame(output_path, models_and_outputs)
+            return
+
         # 分割処理を実行
-        split_segments = split_image(output_path, target_folder, models_and_outputs)
+        split_segments = split_training_frame(
+            output_path, target_folder, models_and_outputs
+        )
         print(f"分割完了: {split_segments}")
 
         # 元の画像を「processed」に移動
@@ -5,26 +5,36 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
 from utils.file import clear_existing_files
 from utils.image import split_image
-from utils.visistory_api import run_predictions
+from utils.change_detector import ChangeDetector
+from utils.metrics import metrics
+from utils.sites import get_sites
 
 # .envファイルの内容を読み込む
 load_dotenv()
 
-# YouTubeライブのURL
-youtube_url = os.getenv("YOUTUBE_URL")
 
+# PyTorch の読み込みとモデルのロードはフレーム取得と並行して行う
+def preload_models(sites):
+    from utils.model_registry import registry
 
-# フレーム取得、分割、予測、API送信の処理
+    registry.warmup = False
+    for site in sites:
+        registry.preload(site.models_and_outputs.keys())
+
+
+# フレーム取得、分割、予測、API送信の処理（1サイト分）
 def capture_split_predict_and_send(
-    youtube_url, output_folder, target_folder, models_and_outputs
+    site, output_folder, target_folder, change_detector, preloaded
 ):
     # 出力ディレクトリを作成
     clear_existing_files(output_folder)
     os.makedirs(output_folder, exist_ok=True)
+    os.makedirs(target_folder, exist_ok=True)
 
     # 現在時刻に基づいてファイル名を作成
     current_time = datetime.now().strftime("%H%M%S")
@@ -32,39 +42,74 @@ def capture_split_predict_and_send(
 
     # yt-dlpでライブストリームの動画データを取得し、ffmpegで1フレームを保存
     command = (
-        f'yt-dlp --cookies cookies.txt -o - -f "best[ext=mp4]" {youtube_url} | '
+        f'yt-dlp --cookies cookies.txt -o - -f "best[ext=mp4]" {site.url} | '
         f'ffmpeg -y -i pipe:0 -frames:v 1 "{output_path}"'
     )
     try:
-        subprocess.run(command, shell=True, check=True)
+        with metrics.timer("capture", site=site.name):
+            subprocess.run(command, shell=True, check=True)
         print(f"フレームが正常に保存されました: {output_path}")
 
         # 分割処理を実行
-        split_segments = split_image(output_path, target_folder, models_and_outputs)
+        split_segments = split_image(
+            output_path, target_folder, site.models_and_outputs, site.layout
+        )
         print(f"分割完了: {split_segments}")
 
         # 分割結果を使って予測とAPI送信を実行
         print(split_segments)
-        prediction_results = run_predictions(split_segments)
-        print(f"予測結果: {prediction_results}")
+        preloaded.result()
+        from utils.visistory_api import run_predictions
+
+        prediction_results = run_predictions(
+            split_segments,
+            source="capture",
+            change_detector=change_detector,
+            parking_lot_ids=site.parking_lot_ids,
+        )
+        print(f"予測結果 ({site.name}): {prediction_results}")
 
     except subprocess.CalledProcessError as e:
-        print(f"エラーが発生しました: {e}")
+        print(f"エラーが発生しました ({site.name}): {e}")
+
+
+def run_site(site, change_detector, preloaded):
+    with metrics.timer("cycle", site=site.name):
+        capture_split_predict_and_send(
+            site,
+            os.path.join(output_folder, site.name),
+            os.path.join(target_folder, site.name),
+            change_detector,
+            preloaded,
+        )
 
 
 # 使用例
 output_folder = "data/upload"
 target_folder = "data/target"
-models_and_outputs = {
-    "models/parking_model_takeda_a.pth": "takeda_a.jpg",
-    "models/parking_model_takeda_b.pth": "takeda_b.jpg",
-    "models/parking_model_takeda_c.pth": "takeda_c.jpg",
-    "models/parking_model_takeda_d.pth": "takeda_d.jpg",
-    "models/parking_model_rittai_p.pth": "rittai_p.jpg",
-    "models/parking_model_bottom.pth": "bottom.jpg",
-}
 
 # 実行
-capture_split_predict_and_send(
-    youtube_url, output_folder, target_folder, models_and_outputs
-)
+# 設定ファイルの全サイトを並行に取得・予測する（モデルはプロセス内で共有）
+try:
+    # 前回の実行から変化のない駐車場は推論を省略する（状態はファイルに保存）
+    change_detector = ChangeDetector(
+        threshold=float(os.getenv("CHANGE_THRESHOLD", "4.0")),
+        state_path=os.getenv("CHANGE_STATE_FILE", "data/change_state.json"),
+    )
+    sites = list(get_sites().values())
+    with ThreadPoolExecutor(max_workers=1) as preloader, ThreadPoolExecutor(
+        max_workers=len(sites)
+    ) as executor:
+        preloaded = preloader.submit(preload_models, sites)
+        futures = [
+            executor.submit(run_site, site, change_detector, preloaded)
+            for site in sites
+        ]
+        for site, future in zip(sites, futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"{site.name} の処理でエラーが発生しました: {e}")
+finally:
+    # 段階ごとの処理時間を Prometheus のテキスト形式で保存する
+    metrics.dump(os.getenv("METRICS_FILE", "data/metrics/capture.prom"))
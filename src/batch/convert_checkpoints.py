@@ -0,0 +1,59 @@
+import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+
+import torch
+from utils.backends import checkpoint_path
+from utils.checkpoint import load_checkpoint, read_metadata, save_checkpoint
+from utils.predict import checkpoint_metadata
+from utils.sites import get_sites
+
+
+# .pth の重みをメモリマップで読み込める形式（.safetensors）に変換し、同じ値が読めることを確認する
+def convert(model_path):
+    state_dict = torch.load(model_path, map_location="cpu")
+    path = save_checkpoint(
+        checkpoint_path(model_path),
+        state_dict,
+        checkpoint_metadata(source=os.path.basename(model_path)),
+    )
+
+    loaded, _ = load_checkpoint(path)
+    if loaded.keys() != state_dict.keys() or not all(
+        torch.equal(loaded[name], tensor) for name, tensor in state_dict.items()
+    ):
+        os.remove(path)
+        raise ValueError(f"{path} does not match {model_path}")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="学習済みモデル（.pth）をメモリマップで読み込める .safetensors に変換する"
+    )
+    parser.add_argument(
+        "model_paths",
+        nargs="*",
+        help="変換する .pth（省略時は設定ファイルの全サイトのモデル）",
+    )
+    args = parser.parse_args()
+
+    model_paths = args.model_paths or [
+        model_path
+        for site in get_sites().values()
+        for model_path in site.models_and_outputs
+    ]
+    for model_path in model_paths:
+        if not os.path.exists(model_path):
+            print(f"モデルファイル {model_path} が存在しません。")
+            continue
+        path = convert(model_path)
+        print(f"{model_path} -> {path} {read_metadata(path)}")
+
+
+if __name__ == "__main__":
+    main()
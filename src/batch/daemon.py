@@ -0,0 +1,342 @@
+import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import queue
+import signal
+import threading
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+from utils.capture_schedule import CaptureScheduler
+from utils.change_detector import ChangeDetector
+from utils.history import record_results
+from utils.image import split_image_array
+from utils.metrics import lot_name, metrics
+from utils.sites import get_site, get_sites
+from utils.stream import FrameSource
+
+# .envファイルの内容を読み込む
+load_dotenv()
+
+# 各ステージの終了を下流に伝える印
+STOP = object()
+# シグナル受信やステージの異常終了で立てる停止フラグ
+stop_event = threading.Event()
+
+
+# 最新を優先するキュー投入（満杯なら一番古い要素を捨てる）
+def put_latest(q, item):
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                dropped = q.get_nowait()
+                metrics.inc("frames_dropped_total")
+                print(f"処理が追いつかないため {dropped[0]} のフレームを破棄しました")
+            except queue.Empty:
+                pass
+
+
+# 各ステージは上流のキューから取り出し、下流のキューへ渡す
+# 下流が詰まっている場合は put がブロックしてバックプレッシャーになる
+# フレーム取得と分割/前処理はサイトごとのスレッドで並行に行い、推論と送信は全サイトで共有する
+# PyTorch を使うモジュールは、ストリームへの接続を始めてから各ステージの中で読み込む
+# 取得間隔はサイトごとのスケジューラが駐車場の変化に合わせて決める
+def capture_stage(site, source, scheduler, stop_event, out_queue):
+    last_count = 0
+    try:
+        for tick in scheduler.ticks(stop_event):
+            with metrics.timer("capture"):
+                frame, frame_time, last_count = source.read(
+                    timeout=min(scheduler.interval, 60), after=last_count
+                )
+            if frame is None:
+                metrics.inc("stage_errors_total", stage="capture", site=site.name)
+                print(f"{site.name}: フレームを取得できませんでした")
+                continue
+            captured_at = datetime.fromtimestamp(frame_time).isoformat(
+                timespec="seconds"
+            )
+            put_latest(out_queue, (captured_at, frame))
+    finally:
+        out_queue.put(STOP)
+
+
+def preprocess_stage(site, in_queue, out_queue, device, change_detector):
+    from utils.predict import preprocess_batch
+
+    while True:
+        item = in_queue.get()
+        if item is STOP:
+            break
+        captured_at, frame = item
+        try:
+            # 前回から変化のないセグメントは前処理・推論を省略し、前回の結果を使う
+            cached = {}
+            pending = []
+            differences = []
+            for segment, model_path, output_name in split_image_array(
+                frame, site.models_and_outputs, site.layout
+            ):
+                signature = change_detector.signature(segment)
+                differences.append(change_detector.difference(output_name, signature))
+                status = change_detector.lookup(output_name, signature)
+                if status is None:
+                    pending.append((segment, model_path, output_name, signature))
+                else:
+                    cached[output_name] = status
+                    metrics.inc("segments_skipped_total", lot=lot_name(output_name))
+            images = None
+            if pending:
+                images = preprocess_batch([item[0] for item in pending], device)
+        except Exception as e:
+            print(f"{site.name}: 前処理でエラーが発生しました ({captured_at}): {e}")
+            continue
+        # 取得間隔の調整に使う、区画ごとの画素の差の最大値
+        difference = max((d for d in differences if d is not None), default=None)
+        out_queue.put((site, captured_at, cached, pending, images, difference))
+    out_queue.put(STOP)
+
+
+# 全サイトの前処理ステージから届いたフレームを、その時点でキューにあるだけまとめて推論する
+# producers 個の前処理ステージが全て終了したら下流に終了を伝える
+def inference_stage(in_queue, out_queue, change_detector, producers, model_paths):
+    remaining = producers
+    while remaining:
+        items = []
+        item = in_queue.get()
+        while True:
+            if item is STOP:
+                remaining -= 1
+            else:
+                items.append(item)
+            if not remaining:
+                break
+            try:
+                item = in_queue.get_nowait()
+            except queue.Empty:
+                break
+        if items:
+            infer_frames(items, out_queue, change_detector, model_paths)
+    out_queue.put(STOP)
+
+
+# 推論する切り出し画像の組み合わせはフレームごとに変わるので、全サイトのモデル（model_paths）の
+# アンサンブルを1つだけ使い、切り出し画像をモデル（共有バックボーン）ごとにまとめて推論する
+def infer_frames(items, out_queue, change_detector, model_paths):
+    import torch
+    from utils.model_registry import registry
+    from utils.predict import predict_tensors
+
+    pending = [entry for _, _, _, frame_pending, *_ in items for entry in frame_pending]
+    statuses = []
+    if pending:
+        try:
+            ensemble, _ = registry.get_ensemble(
+                [model_path for _, model_path, _, _ in pending], model_set=model_paths
+            )
+            images = torch.cat(
+                [
+                    frame_images
+                    for *_, frame_images, _ in items
+                    if frame_images is not None
+                ]
+            )
+            statuses = predict_tensors(images, ensemble)
+        except Exception as e:
+            captured = [f"{site.name} {captured_at}" for site, captured_at, *_ in items]
+            print(f"推論でエラーが発生しました ({', '.join(captured)}): {e}")
+            return
+
+    statuses = iter(statuses)
+    for site, captured_at, cached, frame_pending, _, difference in items:
+        results = dict(cached)
+        for (_, _, output_name, signature), status in zip(frame_pending, statuses):
+            change_detector.update(output_name, signature, status)
+            results[output_name] = status
+        out_queue.put((site, captured_at, results, difference))
+    print(f"変化検出: {change_detector.stats()}")
+
+
+def send_stage(in_queue, schedulers):
+    from utils.visistory_api import send_results
+
+    while True:
+        item = in_queue.get()
+        if item is STOP:
+            break
+        site, captured_at, results, difference = item
+        print(f"予測結果 ({site.name} {captured_at}): {results}")
+        # 予測結果と画素の差から次の取得間隔を決め、実効サンプリングレートを記録する
+        scheduler = schedulers[site.name]
+        scheduler.observe(results, difference)
+        print(
+            f"{site.name}: 取得間隔 {scheduler.interval:.0f}秒 "
+            f"(実効 {scheduler.effective_rate():.1f} フレーム/時)"
+        )
+        for output_name, status in results.items():
+            metrics.inc("predictions_total", lot=lot_name(output_name), status=status)
+        record_results(results, ts=captured_at, source="daemon")
+        try:
+            sent = send_results(results, site.parking_lot_ids)
+            print(f"送信完了: {sent}")
+        except Exception as e:
+            print(f"送信でエラーが発生しました: {e}")
+        # フレーム取得から送信完了までの時間
+        metrics.observe(
+            "stage_seconds",
+            time.time() - datetime.fromisoformat(captured_at).timestamp(),
+            stage="cycle",
+            site=site.name,
+        )
+
+
+def run_stage(target, *args):
+    def wrapper():
+        try:
+            target(*args)
+        except Exception as e:
+            print(f"{target.__name__} でエラーが発生しました: {e}")
+            stop_event.set()
+
+    thread = threading.Thread(target=wrapper, name=target.__name__)
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="フレーム取得・分割・予測・API送信を常駐して並行処理する"
+    )
+    parser.add_argument(
+        "--site",
+        action="append",
+        default=None,
+        help="監視するサイト名（複数指定可、省略時は設定ファイルの全サイト）",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=None,
+        help="固定の取得間隔（秒、省略時はサイトごとの設定で変化に合わせて調整）",
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=2, help="各ステージ間のキュー長"
+    )
+    parser.add_argument("--decode-fps", type=float, default=1.0)
+    parser.add_argument(
+        "--backend",
+        default=None,
+        choices=["yt-dlp", "streamlink"],
+        help="省略時はサイトごとの設定",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=os.getenv("METRICS_FILE", "data/metrics/daemon.prom"),
+        help="段階ごとの処理時間を Prometheus のテキスト形式で書き出すファイル",
+    )
+    parser.add_argument(
+        "--metrics-interval", type=float, default=60, help="書き出し間隔（秒）"
+    )
+    args = parser.parse_args()
+
+    if args.site:
+        sites = [get_site(name) for name in args.site]
+    else:
+        sites = list(get_sites().values())
+
+    def request_stop(signum, frame):
+        print("終了シグナルを受け取りました。処理中のフレームを完了してから終了します")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # 前処理済みのフレームは全サイトで1つのキューに集め、推論をまとめる
+    preprocessed = queue.Queue(maxsize=args.queue_size * len(sites))
+    predicted = queue.Queue(maxsize=args.queue_size * len(sites))
+
+    change_detector = ChangeDetector(
+        threshold=float(os.getenv("CHANGE_THRESHOLD", "4.0"))
+    )
+
+    sources = []
+    threads = []
+    metrics_thread = metrics.start_dump(
+        args.metrics_file, args.metrics_interval, stop_event
+    )
+    try:
+        # ストリームの URL の解決と接続は各 FrameSource のスレッドで行われるので、
+        # 先に開始しておき、その間にモデルをロードする
+        for site in sites:
+            source = FrameSource(
+                site.url,
+                backend=args.backend or site.backend,
+                decode_fps=args.decode_fps,
+            )
+            source.start()
+            sources.append(source)
+
+        # 全サイトのモデルは起動時に1回だけロードしてメモリに保持する
+        # （PyTorch の読み込みとモデルのロードは、ストリームへの接続と並行して行う）
+        from utils.model_registry import registry
+
+        model_paths = [
+            model_path for site in sites for model_path in site.models_and_outputs
+        ]
+        registry.preload(model_paths)
+        _, device = registry.get(next(iter(sites[0].models_and_outputs)))
+
+        schedulers = {
+            site.name: CaptureScheduler.from_site(site, args.interval) for site in sites
+        }
+        for site, source in zip(sites, sources):
+            captured = queue.Queue(maxsize=args.queue_size)
+            threads += [
+                run_stage(
+                    capture_stage,
+                    site,
+                    source,
+                    schedulers[site.name],
+                    stop_event,
+                    captured,
+                ),
+                run_stage(
+                    preprocess_stage,
+                    site,
+                    captured,
+                    preprocessed,
+                    device,
+                    change_detector,
+                ),
+            ]
+        threads += [
+            run_stage(
+                inference_stage,
+                preprocessed,
+                predicted,
+                change_detector,
+                len(sites),
+                model_paths,
+            ),
+            run_stage(send_stage, predicted, schedulers),
+        ]
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+    finally:
+        for source in sources:
+            source.close()
+        stop_event.set()
+        metrics_thread.join()
+    print("デーモンを終了しました")
+
+
+if __name__ == "__main__":
+    main()
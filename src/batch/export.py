@@ -0,0 +1,162 @@
+import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import glob
+import json
+import random
+import time
+
+import torch
+from utils.backends import (
+    artifact_path,
+    export_int8_dynamic,
+    export_int8_static,
+    export_onnx,
+    export_torchscript,
+    load_backend,
+)
+from utils.predict import load_model, preprocess_image
+
+# 学習済みモデルと、較正・精度確認に使う分割画像のフォルダ
+models_and_splits = [
+    ("models/parking_model_takeda_a.pth", "data/train/split/takeda_a"),
+    ("models/parking_model_takeda_b.pth", "data/train/split/takeda_b"),
+    ("models/parking_model_takeda_c.pth", "data/train/split/takeda_c"),
+    ("models/parking_model_takeda_d.pth", "data/train/split/takeda_d"),
+    ("models/parking_model_rittai_p.pth", "data/train/split/rittai_p"),
+    ("models/parking_model_bottom.pth", "data/train/split/bottom"),
+]
+
+
+def load_batches(image_paths, batch_size=32):
+    for i in range(0, len(image_paths), batch_size):
+        yield torch.cat(
+            [preprocess_image(path, "cpu") for path in image_paths[i : i + batch_size]]
+        )
+
+
+# float32 モデルと書き出したモデルの予測ラベルを比較する
+def check_parity(float_model, backend_model, image_paths):
+    agree = 0
+    total = 0
+    max_abs_diff = 0.0
+    float_seconds = 0.0
+    backend_seconds = 0.0
+
+    with torch.no_grad():
+        for images in load_batches(image_paths):
+            start = time.perf_counter()
+            expected = float_model(images)
+            float_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            actual = backend_model(images)
+            backend_seconds += time.perf_counter() - start
+
+            agree += int((expected.argmax(1) == actual.argmax(1)).sum())
+            total += images.size(0)
+            max_abs_diff = max(max_abs_diff, float((expected - actual).abs().max()))
+
+    return {
+        "samples": total,
+        "agreement": agree / total if total else None,
+        "max_abs_logit_diff": max_abs_diff,
+        "float_seconds": float_seconds,
+        "backend_seconds": backend_seconds,
+        "speedup": float_seconds / backend_seconds if backend_seconds else None,
+    }
+
+
+def export_model(model_path, split_dir, backends, calibration_samples, parity_samples):
+    float_model, _ = load_model(model_path)
+    float_model = float_model.cpu().eval()
+
+    # 較正用と精度確認用に、分割画像を重ならないように選ぶ
+    image_paths = sorted(glob.glob(os.path.join(split_dir, "*.jpg")))
+    random.Random(0).shuffle(image_paths)
+    calibration_paths = image_paths[:calibration_samples]
+    parity_paths = image_paths[calibration_samples:][:parity_samples] or (
+        calibration_paths
+    )
+
+    report = {}
+    for backend in backends:
+        path = artifact_path(model_path, backend)
+        if backend == "torchscript":
+            export_torchscript(float_model, path)
+        elif backend == "onnx":
+            export_onnx(float_model, path)
+        elif backend == "int8_dynamic":
+            export_int8_dynamic(float_model, path)
+        elif backend == "int8_static":
+            if not calibration_paths:
+                print(f"{split_dir} に較正用の画像がないため int8_static をスキップ")
+                continue
+            export_int8_static(float_model, path, load_batches(calibration_paths))
+
+        backend_model, _ = load_backend(model_path, backend, torch.device("cpu"))
+        report[backend] = {"path": path}
+        if parity_paths:
+            parity = check_parity(float_model, backend_model, parity_paths)
+            report[backend].update(parity)
+        print(f"{path}: {report[backend]}")
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="学習済みモデルを TorchScript / ONNX / int8 に書き出し、精度を確認する"
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["torchscript", "onnx", "int8_dynamic", "int8_static"],
+        choices=["torchscript", "onnx", "int8_dynamic", "int8_static"],
+    )
+    parser.add_argument("--calibration-samples", type=int, default=200)
+    parser.add_argument("--parity-samples", type=int, default=500)
+    parser.add_argument(
+        "--min-agreement",
+        type=float,
+        default=0.99,
+        help="float モデルとのラベル一致率がこれを下回ると失敗とする",
+    )
+    parser.add_argument("--report", default="models/export_report.json")
+    args = parser.parse_args()
+
+    reports = {}
+    failed = []
+    for model_path, split_dir in models_and_splits:
+        if not os.path.exists(model_path):
+            print(f"モデルファイル {model_path} が存在しません。")
+            continue
+        reports[model_path] = export_model(
+            model_path,
+            split_dir,
+            args.backends,
+            args.calibration_samples,
+            args.parity_samples,
+        )
+        for backend, result in reports[model_path].items():
+            agreement = result.get("agreement")
+            if agreement is not None and agreement < args.min_agreement:
+                failed.append(f"{model_path} [{backend}] agreement={agreement:.4f}")
+
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(reports, f, indent=2, ensure_ascii=False)
+    print(f"レポートを保存しました: {args.report}")
+
+    if failed:
+        print("float モデルと予測が一致しないバックエンドがあります:")
+        for line in failed:
+            print(f"  {line}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
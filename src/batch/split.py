@@ -1,65 +1,123 @@
-from PIL import Image
 import os
-import glob
-import shutil  # ファイル移動のためにインポート
-
-
-def split_image(filepath, target_folder, models_and_outputs):
-    # 画像を開く
-    image = Image.open(filepath)
-    width, height = image.size
-    segment_height = height // 6  # 6分割する高さ
-    segments = []
-
-    # ファイル名と日付パスを取得
-    original_filename = os.path.basename(filepath)  # 例: frame_0002.jpg
-    date_str = (
-        os.path.dirname(filepath).replace("data/train/raw/", "").replace("/", "_")
-    )  # 日付ディレクトリを "2024_11_06" に変換
-
-    # 保存用のファイル名を生成（例: 2024_11_06_frame_0002.jpg）
-    base_filename = f"{date_str}_{original_filename}"
-
-    # 各モデル名に応じて分割して保存
-    for i, (model_name, _) in enumerate(models_and_outputs.items()):
-        box = (0, i * segment_height, width, (i + 1) * segment_height)
-        segment = image.crop(box)
-
-        # 各セグメントの保存先を設定
-        model_folder = os.path.join(target_folder, model_name)
-        os.makedirs(model_folder, exist_ok=True)
+import sys
 
-        segment_path = os.path.join(
-            model_folder, base_filename
-        )  # 動的なファイル名を使用
-        segment.save(segment_path)
-        segments.append((segment_path, model_name, base_filename))
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
-    return segments
-
-
-def process_all_images(output_folder, target_folder, models_and_outputs):
+import glob
+import json
+import time
+import shutil  # ファイル移動のためにインポート
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils.image import split_training_frame
+
+
+# 処理済みの元画像を記録するマニフェスト（1行1画像の JSON、追記のみ）
+def load_manifest(manifest_path):
+    done = set()
+    if not os.path.exists(manifest_path):
+        return done
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["source"])
+            except (ValueError, KeyError):
+                # 書き込み途中で中断した最終行は無視する
+                continue
+    return done
+
+
+def append_manifest(manifest_file, entry):
+    manifest_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    manifest_file.flush()
+    os.fsync(manifest_file.fileno())
+
+
+# 元の画像を processed 内の同じ構造の場所に移動する
+def move_to_processed(filepath, output_folder, processed_base_dir):
+    relative_path = os.path.relpath(filepath, output_folder)
+    processed_path = os.path.join(processed_base_dir, relative_path)
+    os.makedirs(os.path.dirname(processed_path), exist_ok=True)
+    shutil.move(filepath, processed_path)
+    return processed_path
+
+
+def process_all_images(
+    output_folder,
+    target_folder,
+    models_and_outputs,
+    manifest_path="data/train/split_manifest.jsonl",
+    workers=None,
+    min_size=224,
+):
     # outputフォルダ内の全ての画像ファイルを取得
-    all_images = glob.glob(os.path.join(output_folder, "**", "*.jpg"), recursive=True)
+    all_images = sorted(
+        glob.glob(os.path.join(output_folder, "**", "*.jpg"), recursive=True)
+    )
 
     # 分割済みの元画像を移動するディレクトリ（sample_dataと同じ構造）
     processed_base_dir = os.path.join(output_folder, "../processed")
 
+    # マニフェストに記録済みの画像は分割をスキップし、移動だけやり直す
+    # （分割 → マニフェスト記録 → 移動 の順なので、どこで中断しても再実行で続きから処理できる）
+    done = load_manifest(manifest_path)
+    pending = []
     for filepath in all_images:
-        # 各画像を分割して保存
-        segments = split_image(filepath, target_folder, models_and_outputs)
-        print(f"{filepath} の分割結果: {segments}")
-
-        # 元の画像の相対パスを取得し、processed_data内で同じ構造にする
-        relative_path = os.path.relpath(filepath, output_folder)
-        processed_path = os.path.join(processed_base_dir, relative_path)
-
-        # processed_data内のディレクトリ構造を再現
-        os.makedirs(os.path.dirname(processed_path), exist_ok=True)
-
-        # 元の画像を processed_data 内の対応するディレクトリに移動
-        shutil.move(filepath, processed_path)
-        print(f"元の画像 {filepath} を {processed_path} に移動しました")
+        source = os.path.relpath(filepath, output_folder)
+        if source in done:
+            move_to_processed(filepath, output_folder, processed_base_dir)
+        else:
+            pending.append(filepath)
+    print(f"{len(all_images)}枚中 {len(pending)}枚を分割します")
+
+    start = time.perf_counter()
+    processed = 0
+    failed = 0
+    input_bytes = 0
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    with open(manifest_path, "a", encoding="utf-8") as manifest_file:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    split_training_frame,
+                    filepath,
+                    target_folder,
+                    models_and_outputs,
+                    min_size,
+                ): filepath
+                for filepath in pending
+            }
+            for future in as_completed(futures):
+                filepath = futures[future]
+                try:
+                    segments = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"{filepath} の分割でエラーが発生しました: {e}")
+                    continue
+
+                input_bytes += os.path.getsize(filepath)
+                append_manifest(
+                    manifest_file,
+                    {
+                        "source": os.path.relpath(filepath, output_folder),
+                        "segments": [segment_path for segment_path, _, _ in segments],
+                        "processed_at": time.time(),
+                    },
+                )
+                processed_path = move_to_processed(
+                    filepath, output_folder, processed_base_dir
+                )
+                processed += 1
+                print(f"元の画像 {filepath} を {processed_path} に移動しました")
+
+    seconds = time.perf_counter() - start
+    print(
+        f"分割完了: {processed}枚 (失敗 {failed}枚), {seconds:.1f}秒, "
+        f"{processed / seconds if seconds else 0:.1f} 枚/秒, "
+        f"{input_bytes / 1024 / 1024 / seconds if seconds else 0:.1f} MB/秒"
+    )
 
 
 # 使用例
@@ -75,4 +133,23 @@ models_and_outputs = {
 }
 
 # 実行
-process_all_images(output_folder, target_folder, models_and_outputs)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="収集した元画像を並列に分割する")
+    parser.add_argument("--workers", type=int, default=None, help="プロセス数")
+    parser.add_argument(
+        "--min-size",
+        type=int,
+        default=224,
+        help="縮小デコード後も各セグメントが保つ最小サイズ（0 で縮小しない）",
+    )
+    parser.add_argument("--manifest", default="data/train/split_manifest.jsonl")
+    args = parser.parse_args()
+
+    process_all_images(
+        output_folder,
+        target_folder,
+        models_and_outputs,
+        manifest_path=args.manifest,
+        workers=args.workers,
+        min_size=args.min_size,
+    )
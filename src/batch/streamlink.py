@@ -1,47 +1,85 @@
 import os
-import subprocess
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import threading
 from datetime import datetime
-import time
+from PIL import Image
 from dotenv import load_dotenv
+from utils.capture_schedule import CaptureScheduler
+from utils.change_detector import ChangeDetector
+from utils.frame_archive import FrameArchive
+from utils.image import split_image_array
+from utils.sites import get_site
+from utils.stream import FrameSource
 
 # .envファイルの内容を読み込む
 load_dotenv()
 
 # YouTubeライブのURL
 youtube_url = os.getenv("YOUTUBE_URL")
-# 出力するフレームの間隔（秒）
-frame_interval = 600  # 10分ごとに1フレーム
+# 出力するフレームの間隔（秒）は、サイトの設定（interval / schedule）に従い
+# 駐車場の見た目が変わっている間は短く、変わらなければ長くする
+site = get_site()
+scheduler = CaptureScheduler.from_site(site)
+# 区画ごとに前回のフレームとの画素の差を求める（予測はしないので状態は持たない）
+change_detector = ChangeDetector(max_age=None)
+stop_event = threading.Event()
+# FRAME_ARCHIVE を設定した場合は、フレームを1枚ずつのファイルではなくアーカイブのシャードに追記する
+archive = FrameArchive() if os.getenv("FRAME_ARCHIVE") else None
+lot_names = [lot["name"] for lot in site.lots]
 
-# 初期の日付に基づいて出力ディレクトリを作成
-current_date = datetime.now().strftime("%Y/%m/%d")
-output_dir = f"data/train/raw/{current_date}"
-os.makedirs(output_dir, exist_ok=True)
+# ストリームへの接続を1本だけ維持し、フレームはメモリ上で受け取る
+source = FrameSource(youtube_url, backend="streamlink")
+source.start()
 
 try:
-    while True:
-        # 日付が変わったかをチェック
-        new_date = datetime.now().strftime("%Y/%m/%d")
-        if new_date != current_date:
-            # 新しい日付に基づいたディレクトリを作成
-            output_dir = f"sample_data/{new_date}"
+    last_count = 0
+    for tick in scheduler.ticks(stop_event):
+        frame, captured_at, last_count = source.read(timeout=60, after=last_count)
+        if frame is None:
+            print("フレームを取得できませんでした")
+            continue
+
+        captured = datetime.fromtimestamp(captured_at)
+        if archive is not None:
+            height, width = frame.shape[:2]
+            key, stored = archive.add_array(
+                frame,
+                captured.isoformat(timespec="seconds"),
+                site=site.name,
+                rects=site.layout.rects(lot_names, width, height),
+            )
+            print(f"フレームをアーカイブしました: {key[:12]}{'' if stored else '（重複）'}")
+        else:
+            # 取得時刻に基づいて出力ディレクトリとファイル名を作成
+            output_dir = f"data/train/raw/{captured.strftime('%Y/%m/%d')}"
             os.makedirs(output_dir, exist_ok=True)
-            current_date = new_date  # 日付を更新
+            output_path = f"{output_dir}/frame_{captured.strftime('%H%M%S')}.jpg"
 
-        # 現在時刻に基づいてファイル名を作成
-        current_time = datetime.now().strftime("%H%M%S")
-        output_path = f"{output_dir}/frame_{current_time}.jpg"
+            Image.fromarray(frame).save(output_path)
+            print(f"フレームが正常に保存されました: {output_path}")
 
-        # streamlinkとffmpegを使って1フレームを取得
-        command = (
-            f'streamlink -O "{youtube_url}" best | '
-            f'ffmpeg -y -i - -frames:v 1 "{output_path}"'
+        differences = []
+        for segment, _, output_name in split_image_array(
+            frame, site.models_and_outputs, site.layout
+        ):
+            signature = change_detector.signature(segment)
+            differences.append(change_detector.difference(output_name, signature))
+            change_detector.update(output_name, signature, None)
+        scheduler.observe(
+            difference=max((d for d in differences if d is not None), default=None)
+        )
+        print(
+            f"次の取得まで {scheduler.interval:.0f}秒 "
+            f"(実効 {scheduler.effective_rate():.1f} フレーム/時)"
         )
-
-        # サブプロセスでコマンドを実行
-        subprocess.run(command, shell=True)
-
-        # 次のフレーム抽出まで待機
-        time.sleep(frame_interval)
 
 except KeyboardInterrupt:
     print("フレーム抽出が終了しました")
+finally:
+    source.close()
+    if archive is not None:
+        archive.close()
@@ -1,10 +1,20 @@
 import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import time
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torchvision import datasets, models, transforms
 from torch.utils.data import DataLoader
-from torchvision.models import ResNet18_Weights
+from utils.backends import checkpoint_path
+from utils.checkpoint import save_checkpoint
+from utils.predict import checkpoint_metadata
+from utils.tensor_cache import CachedImageDataset, build_cache
 
 # データセットの前処理
 data_transforms = {
@@ -36,82 +46,158 @@ datasets_and_models = [
 ]
 
 
-# トレーニング関数
-def train_model(model, criterion, optimizer, num_epochs, dataloaders, dataset_sizes):
-    for epoch in range(num_epochs):
-        print("Epoch {}/{}".format(epoch, num_epochs - 1))
-        print("-" * 10)
+# 1エポック分（train または val）の処理
+# 戻り値: (loss, acc, 画像枚数, 経過秒数)
+def run_epoch(model, criterion, optimizer, dataloader, phase, dataset_size):
+    if phase == "train":
+        model.train()
+    else:
+        model.eval()
 
-        for phase in ["train", "val"]:
-            if phase == "train":
-                model.train()
-            else:
-                model.eval()
+    running_loss = 0.0
+    running_corrects = 0
+    start = time.perf_counter()
 
-            running_loss = 0.0
-            running_corrects = 0
+    for inputs, labels in dataloader:
+        inputs = inputs.to(device)
+        labels = labels.to(device)
 
-            for inputs, labels in dataloaders[phase]:
-                inputs = inputs.to(device)
-                labels = labels.to(device)
+        optimizer.zero_grad()
 
-                optimizer.zero_grad()
+        with torch.set_grad_enabled(phase == "train"):
+            outputs = model(inputs)
+            _, preds = torch.max(outputs, 1)
+            loss = criterion(outputs, labels)
 
-                with torch.set_grad_enabled(phase == "train"):
-                    outputs = model(inputs)
-                    _, preds = torch.max(outputs, 1)
-                    loss = criterion(outputs, labels)
+            if phase == "train":
+                loss.backward()
+                optimizer.step()
+
+        running_loss += loss.item() * inputs.size(0)
+        running_corrects += torch.sum(preds == labels.data)
 
-                    if phase == "train":
-                        loss.backward()
-                        optimizer.step()
+    seconds = time.perf_counter() - start
+    epoch_loss = running_loss / dataset_size
+    epoch_acc = float(running_corrects.double() / dataset_size)
+    return epoch_loss, epoch_acc, dataset_size, seconds
 
-                running_loss += loss.item() * inputs.size(0)
-                running_corrects += torch.sum(preds == labels.data)
 
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects.double() / dataset_sizes[phase]
+# トレーニング関数
+def train_model(model, criterion, optimizer, num_epochs, dataloaders, dataset_sizes):
+    for epoch in range(num_epochs):
+        print("Epoch {}/{}".format(epoch, num_epochs - 1))
+        print("-" * 10)
+
+        for phase in ["train", "val"]:
+            epoch_loss, epoch_acc, _, _ = run_epoch(
+                model,
+                criterion,
+                optimizer,
+                dataloaders[phase],
+                phase,
+                dataset_sizes[phase],
+            )
 
             print("{} Loss: {:.4f} Acc: {:.4f}".format(phase, epoch_loss, epoch_acc))
 
     return model
 
 
-# デバイスの設定
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# 学習するモデル（ImageNet で事前学習した ResNet18 の出力層を3クラスに置き換える）
+# pretrained=False なら事前学習の重みを取得しない（オフラインの環境向け）
+def build_model(pretrained=True):
+    weights = None
+    if pretrained:
+        from torchvision.models import ResNet18_Weights
 
-# 各データセットに対してトレーニングを実行
-for data_dir, model_path in datasets_and_models:
-    print(f"Training on dataset: {data_dir}")
-    image_datasets = {
-        x: datasets.ImageFolder(os.path.join(data_dir, x), data_transforms[x])
-        for x in ["train", "val"]
-    }
+        weights = ResNet18_Weights.IMAGENET1K_V1
+    model = models.resnet18(weights=weights)
+    num_ftrs = model.fc.in_features
+    model.fc = nn.Linear(num_ftrs, 3)
+    return model.to(device)
+
+
+# データローダーの作成
+# cache_dir を指定した場合はデコード済みの memmap キャッシュから読み込む
+def build_dataloaders(data_dir, cache_dir=None, batch_size=32, num_workers=4):
+    if cache_dir is not None:
+        image_datasets = {}
+        for x in ["train", "val"]:
+            phase_cache = build_cache(
+                os.path.join(data_dir, x), os.path.join(cache_dir, x)
+            )
+            image_datasets[x] = CachedImageDataset(phase_cache, train=(x == "train"))
+    else:
+        image_datasets = {
+            x: datasets.ImageFolder(os.path.join(data_dir, x), data_transforms[x])
+            for x in ["train", "val"]
+        }
     dataloaders = {
-        x: DataLoader(image_datasets[x], batch_size=32, shuffle=True, num_workers=4)
+        x: DataLoader(
+            image_datasets[x],
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=num_workers,
+        )
         for x in ["train", "val"]
     }
     dataset_sizes = {x: len(image_datasets[x]) for x in ["train", "val"]}
+    return dataloaders, dataset_sizes
+
+
+# デバイスの設定
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    # モデルのロードと微調整
-    model = models.resnet18(weights=ResNet18_Weights.IMAGENET1K_V1)
-    num_ftrs = model.fc.in_features
-    model.fc = nn.Linear(num_ftrs, 3)
-    model = model.to(device)
-
-    criterion = nn.CrossEntropyLoss()
-    optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
-
-    # モデルのトレーニング
-    model = train_model(
-        model,
-        criterion,
-        optimizer,
-        num_epochs=25,
-        dataloaders=dataloaders,
-        dataset_sizes=dataset_sizes,
-    )
 
-    # モデルの保存
-    torch.save(model.state_dict(), model_path)
-    print(f"Model saved to {model_path}")
+def main():
+    parser = argparse.ArgumentParser(description="駐車場ごとのモデルを学習する")
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="デコード済み画像のキャッシュ先（例: data/cache）",
+    )
+    parser.add_argument("--epochs", type=int, default=25)
+    parser.add_argument(
+        "--no-pretrained",
+        action="store_true",
+        help="ImageNet の事前学習の重みを使わずに学習する",
+    )
+    args = parser.parse_args()
+
+    # 各データセットに対してトレーニングを実行
+    for data_dir, model_path in datasets_and_models:
+        print(f"Training on dataset: {data_dir}")
+        cache_dir = None
+        if args.cache_dir is not None:
+            cache_dir = os.path.join(args.cache_dir, os.path.basename(data_dir))
+        dataloaders, dataset_sizes = build_dataloaders(data_dir, cache_dir)
+
+        # モデルのロードと微調整
+        model = build_model(pretrained=not args.no_pretrained)
+
+        criterion = nn.CrossEntropyLoss()
+        optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+
+        # モデルのトレーニング
+        model = train_model(
+            model,
+            criterion,
+            optimizer,
+            num_epochs=args.epochs,
+            dataloaders=dataloaders,
+            dataset_sizes=dataset_sizes,
+        )
+
+        # モデルの保存
+        torch.save(model.state_dict(), model_path)
+        # 推論時にメモリマップで読み込める形式でも保存する
+        save_checkpoint(
+            checkpoint_path(model_path),
+            model.state_dict(),
+            checkpoint_metadata(dataset=data_dir),
+        )
+        print(f"Model saved to {model_path}")
+
+
+if __name__ == "__main__":
+    main()
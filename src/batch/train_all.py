@@ -0,0 +1,249 @@
+import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from train import build_dataloaders, build_model, datasets_and_models, run_epoch
+from utils.backends import checkpoint_path
+from utils.checkpoint import save_checkpoint
+from utils.predict import checkpoint_metadata
+
+
+# プロセスプールの各ワーカーで使うスレッド数を設定する
+def init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+# 一時ファイルに書いてから置き換える（途中で落ちても壊れたファイルを残さない）
+def atomic_save(obj, path):
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+# 1つの駐車場のモデルを学習する（エポックごとにチェックポイントを保存し、再開できる）
+def train_lot(data_dir, model_path, options):
+    lot = os.path.basename(data_dir)
+    checkpoint_dir = os.path.join(options["checkpoint_dir"], lot)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    last_path = os.path.join(checkpoint_dir, "last.pt")
+    best_path = os.path.join(checkpoint_dir, "best.pth")
+
+    cache_dir = None
+    if options["cache_dir"] is not None:
+        cache_dir = os.path.join(options["cache_dir"], lot)
+    dataloaders, dataset_sizes = build_dataloaders(
+        data_dir,
+        cache_dir,
+        batch_size=options["batch_size"],
+        num_workers=options["num_workers"],
+    )
+
+    model = build_model(pretrained=options["pretrained"])
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+
+    state = {
+        "epoch": 0,
+        "best_val_loss": float("inf"),
+        "bad_epochs": 0,
+        "history": [],
+        "stopped_early": False,
+    }
+    if options["resume"] and os.path.exists(last_path):
+        checkpoint = torch.load(last_path, map_location="cpu")
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        state = checkpoint["state"]
+        print(f"[{lot}] エポック {state['epoch']} から再開します")
+
+    while state["epoch"] < options["epochs"] and not state["stopped_early"]:
+        epoch_report = {"epoch": state["epoch"]}
+        for phase in ["train", "val"]:
+            loss, acc, images, seconds = run_epoch(
+                model,
+                criterion,
+                optimizer,
+                dataloaders[phase],
+                phase,
+                dataset_sizes[phase],
+            )
+            epoch_report[phase] = {
+                "loss": loss,
+                "acc": acc,
+                "seconds": seconds,
+                "images_per_sec": images / seconds if seconds else None,
+            }
+        print(
+            f"[{lot}] Epoch {state['epoch']}/{options['epochs'] - 1} "
+            f"train Loss: {epoch_report['train']['loss']:.4f} "
+            f"val Loss: {epoch_report['val']['loss']:.4f} "
+            f"Acc: {epoch_report['val']['acc']:.4f} "
+            f"({epoch_report['train']['images_per_sec']:.1f} img/s)"
+        )
+
+        # 検証ロスが改善しなければ patience エポックで打ち切る
+        val_loss = epoch_report["val"]["loss"]
+        if val_loss < state["best_val_loss"] - options["min_delta"]:
+            state["best_val_loss"] = val_loss
+            state["bad_epochs"] = 0
+            atomic_save(model.state_dict(), best_path)
+        else:
+            state["bad_epochs"] += 1
+            if state["bad_epochs"] >= options["patience"]:
+                state["stopped_early"] = True
+                print(f"[{lot}] 検証ロスが改善しないため早期終了します")
+
+        state["history"].append(epoch_report)
+        state["epoch"] += 1
+        atomic_save(
+            {
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "state": state,
+            },
+            last_path,
+        )
+
+    # 検証ロスが最も小さかった重みをモデルとして保存
+    if not os.path.exists(best_path):
+        atomic_save(model.state_dict(), best_path)
+    best_state = torch.load(best_path, map_location="cpu")
+    atomic_save(best_state, model_path)
+    # 推論時にメモリマップで読み込める形式でも保存する
+    save_checkpoint(
+        checkpoint_path(model_path),
+        best_state,
+        checkpoint_metadata(dataset=data_dir, epochs=state["epoch"]),
+    )
+    print(f"[{lot}] Model saved to {model_path}")
+
+    train_seconds = sum(e["train"]["seconds"] for e in state["history"])
+    report = {
+        "lot": lot,
+        "data_dir": data_dir,
+        "model_path": model_path,
+        "epochs_run": state["epoch"],
+        "stopped_early": state["stopped_early"],
+        "best_val_loss": state["best_val_loss"],
+        "train_images": dataset_sizes["train"],
+        "val_images": dataset_sizes["val"],
+        "mean_epoch_seconds": (
+            sum(e["train"]["seconds"] + e["val"]["seconds"] for e in state["history"])
+            / len(state["history"])
+            if state["history"]
+            else None
+        ),
+        "train_images_per_sec": (
+            dataset_sizes["train"] * len(state["history"]) / train_seconds
+            if train_seconds
+            else None
+        ),
+        "history": state["history"],
+    }
+    os.makedirs(options["report_dir"], exist_ok=True)
+    with open(
+        os.path.join(options["report_dir"], f"{lot}.json"), "w", encoding="utf-8"
+    ) as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="駐車場ごとのモデルをプロセスプールで並列に学習する"
+    )
+    parser.add_argument("--jobs", type=int, default=2, help="同時に学習するモデル数")
+    parser.add_argument(
+        "--threads-per-job",
+        type=int,
+        default=max(1, (os.cpu_count() or 1) // 2),
+        help="1ジョブあたりの PyTorch のスレッド数",
+    )
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=25)
+    parser.add_argument("--patience", type=int, default=5)
+    parser.add_argument("--min-delta", type=float, default=0.0)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--checkpoint-dir", default="checkpoints")
+    parser.add_argument("--report-dir", default="reports/train")
+    parser.add_argument(
+        "--no-resume", action="store_true", help="チェックポイントから再開しない"
+    )
+    parser.add_argument(
+        "--no-pretrained",
+        action="store_true",
+        help="ImageNet の事前学習の重みを使わずに学習する",
+    )
+    parser.add_argument(
+        "--lots", nargs="*", default=None, help="学習する駐車場（例: takeda_a bottom）"
+    )
+    args = parser.parse_args()
+
+    options = {
+        "epochs": args.epochs,
+        "patience": args.patience,
+        "min_delta": args.min_delta,
+        "batch_size": args.batch_size,
+        "num_workers": args.num_workers,
+        "cache_dir": args.cache_dir,
+        "checkpoint_dir": args.checkpoint_dir,
+        "report_dir": args.report_dir,
+        "resume": not args.no_resume,
+        "pretrained": not args.no_pretrained,
+    }
+    jobs = [
+        (data_dir, model_path)
+        for data_dir, model_path in datasets_and_models
+        if args.lots is None or os.path.basename(data_dir) in args.lots
+    ]
+
+    start = time.perf_counter()
+    failed = []
+    # torch のスレッドと fork の相性を避けるため spawn でワーカーを起動する
+    with ProcessPoolExecutor(
+        max_workers=args.jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(args.threads_per_job,),
+    ) as executor:
+        futures = {
+            executor.submit(train_lot, data_dir, model_path, options): data_dir
+            for data_dir, model_path in jobs
+        }
+        # 1つのデータセットが失敗しても他の学習は続ける
+        for future in as_completed(futures):
+            data_dir = futures[future]
+            try:
+                report = future.result()
+                print(
+                    f"{data_dir}: {report['epochs_run']} epochs, "
+                    f"best val loss {report['best_val_loss']:.4f}"
+                )
+            except Exception as e:
+                failed.append(data_dir)
+                print(f"{data_dir} の学習でエラーが発生しました: {e}")
+
+    print(f"全体の学習時間: {time.perf_counter() - start:.1f}秒")
+    if failed:
+        print(f"失敗したデータセット（再実行すると続きから学習します）: {failed}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import json
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import ConcatDataset, DataLoader, Dataset
+from torchvision import datasets
+from train import build_model, data_transforms, datasets_and_models, device
+from utils.checkpoint import save_checkpoint
+from utils.multihead import MultiHeadResNet, load_multihead
+from utils.predict import checkpoint_metadata
+from utils.tensor_cache import CachedImageDataset, build_cache
+
+SHARED_MODEL_PATH = "models/parking_model_shared.safetensors"
+
+
+# 1つの駐車場のデータセットに駐車場の番号を付けて返す（(画像, ラベル, 駐車場の番号)）
+class LotDataset(Dataset):
+    def __init__(self, dataset, lot_index):
+        self.dataset = dataset
+        self.lot_index = lot_index
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        image, label = self.dataset[i]
+        return image, label, self.lot_index
+
+
+def build_lot_dataset(data_dir, phase, cache_dir=None):
+    if cache_dir is not None:
+        phase_cache = build_cache(
+            os.path.join(data_dir, phase), os.path.join(cache_dir, phase)
+        )
+        return CachedImageDataset(phase_cache, train=(phase == "train"))
+    return datasets.ImageFolder(os.path.join(data_dir, phase), data_transforms[phase])
+
+
+# 全駐車場の train / val を1つのデータセットにまとめる
+# val は駐車場ごとの精度を出すため、駐車場ごとのデータセットも返す
+def build_datasets(jobs, cache_dir=None):
+    lot_datasets = {"train": [], "val": []}
+    for lot_index, (data_dir, _) in enumerate(jobs):
+        lot_cache_dir = None
+        if cache_dir is not None:
+            lot_cache_dir = os.path.join(cache_dir, os.path.basename(data_dir))
+        for phase in ["train", "val"]:
+            dataset = build_lot_dataset(data_dir, phase, lot_cache_dir)
+            lot_datasets[phase].append(LotDataset(dataset, lot_index))
+    return {phase: ConcatDataset(lot_datasets[phase]) for phase in lot_datasets}, (
+        lot_datasets["val"]
+    )
+
+
+# 1エポック分の処理。戻り値: (loss, 駐車場ごとの正解数, 駐車場ごとの枚数)
+def run_epoch(model, criterion, optimizer, dataloader, phase, num_lots):
+    model.train(phase == "train")
+    running_loss = 0.0
+    corrects = [0] * num_lots
+    counts = [0] * num_lots
+
+    for inputs, labels, lot_indices in dataloader:
+        inputs = inputs.to(device)
+        labels = labels.to(device)
+        lot_indices = lot_indices.to(device)
+
+        optimizer.zero_grad()
+        with torch.set_grad_enabled(phase == "train"):
+            outputs = model(inputs, lot_indices)
+            _, preds = torch.max(outputs, 1)
+            loss = criterion(outputs, labels)
+            if phase == "train":
+                loss.backward()
+                optimizer.step()
+
+        running_loss += loss.item() * inputs.size(0)
+        correct = (preds == labels).long()
+        corrects = [
+            c + int(correct[lot_indices == i].sum()) for i, c in enumerate(corrects)
+        ]
+        counts = [c + int((lot_indices == i).sum()) for i, c in enumerate(counts)]
+
+    return running_loss / max(sum(counts), 1), corrects, counts
+
+
+# 駐車場ごとのモデル（.pth）の検証データでの精度
+def evaluate_lot_model(model_path, dataset, batch_size):
+    if not os.path.exists(model_path):
+        return None
+    model = build_model(pretrained=False)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.eval()
+    correct = 0
+    with torch.no_grad():
+        for inputs, labels, _ in DataLoader(dataset, batch_size=batch_size):
+            _, preds = torch.max(model(inputs.to(device)), 1)
+            correct += int((preds == labels.to(device)).sum())
+    return correct / len(dataset) if len(dataset) else None
+
+
+# 共有モデルと駐車場ごとのモデルの精度を比べる
+def compare(model, lots, jobs, val_datasets, batch_size):
+    model.eval()
+    report = {}
+    for lot_index, ((_, model_path), dataset) in enumerate(zip(jobs, val_datasets)):
+        correct = 0
+        with torch.no_grad():
+            for inputs, labels, lot_indices in DataLoader(
+                dataset, batch_size=batch_size
+            ):
+                outputs = model(inputs.to(device), lot_indices.to(device))
+                _, preds = torch.max(outputs, 1)
+                correct += int((preds == labels.to(device)).sum())
+        report[lots[lot_index]] = {
+            "val_images": len(dataset),
+            "shared_acc": correct / len(dataset) if len(dataset) else None,
+            "per_lot_acc": evaluate_lot_model(model_path, dataset, batch_size),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="全駐車場でバックボーンを共有するモデル（駐車場ごとに分類ヘッド）を学習する"
+    )
+    parser.add_argument("--epochs", type=int, default=25)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="デコード済み画像のキャッシュ先（例: data/cache）",
+    )
+    parser.add_argument("--output", default=SHARED_MODEL_PATH)
+    parser.add_argument("--report", default="reports/train/multihead.json")
+    parser.add_argument(
+        "--no-pretrained",
+        action="store_true",
+        help="ImageNet の事前学習の重みを使わずに学習する",
+    )
+    parser.add_argument(
+        "--evaluate-only",
+        action="store_true",
+        help="学習せず、保存済みの共有モデルと駐車場ごとのモデルの精度を比べる",
+    )
+    args = parser.parse_args()
+
+    jobs = datasets_and_models
+    lots = [os.path.basename(data_dir) for data_dir, _ in jobs]
+    image_datasets, val_datasets = build_datasets(jobs, args.cache_dir)
+
+    if args.evaluate_only:
+        model = load_multihead(args.output).to(device)
+        if model.lots != lots:
+            raise ValueError(f"Lots in {args.output} {model.lots} do not match {lots}")
+    else:
+        model = MultiHeadResNet(lots)
+        if not args.no_pretrained:
+            backbone = build_model(pretrained=True)
+            backbone.fc = nn.Identity()
+            model.backbone.load_state_dict(backbone.state_dict())
+        model = model.to(device)
+
+        dataloaders = {
+            x: DataLoader(
+                image_datasets[x],
+                batch_size=args.batch_size,
+                shuffle=True,
+                num_workers=args.num_workers,
+            )
+            for x in ["train", "val"]
+        }
+        criterion = nn.CrossEntropyLoss()
+        optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+
+        best_val_loss = float("inf")
+        best_state = None
+        for epoch in range(args.epochs):
+            for phase in ["train", "val"]:
+                loss, corrects, counts = run_epoch(
+                    model, criterion, optimizer, dataloaders[phase], phase, len(lots)
+                )
+                accs = " ".join(
+                    f"{lot}={c / n:.4f}"
+                    for lot, c, n in zip(lots, corrects, counts)
+                    if n
+                )
+                print(
+                    f"Epoch {epoch}/{args.epochs - 1} {phase} Loss: {loss:.4f} {accs}"
+                )
+            # 検証ロスが最も小さかった重みを保存する
+            if loss < best_val_loss:
+                best_val_loss = loss
+                best_state = {
+                    k: v.detach().cpu().clone() for k, v in model.state_dict().items()
+                }
+
+        model.load_state_dict(best_state)
+        save_checkpoint(
+            args.output,
+            best_state,
+            {
+                **checkpoint_metadata(epochs=args.epochs),
+                **model.metadata(),
+            },
+        )
+        print(f"Model saved to {args.output}")
+
+    report = compare(model, lots, jobs, val_datasets, args.batch_size)
+    for lot, result in report.items():
+        per_lot = result["per_lot_acc"]
+        print(f"{lot}: 共有 {result['shared_acc']} / 駐車場ごと {per_lot}")
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import os
+import sys
+
+# src フォルダをモジュール検索パスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import json
+import subprocess
+
+from dotenv import load_dotenv
+
+# .envファイルの内容を読み込む
+load_dotenv()
+
+
+# inter-op のスレッド数を起動直後に設定してから、残りの設定を計測する（子プロセスで実行）
+def tune_once(model_path, inter_op_threads, iterations):
+    import torch
+
+    torch.set_num_interop_threads(inter_op_threads)
+    from utils.cpu_tuning import CpuTuning, autotune
+    from utils.predict import load_model
+
+    tuning = CpuTuning(mode="off")
+    model, device = load_model(model_path)
+    return autotune(model, device, tuning, iterations=iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="このホストで CPU の推論設定（スレッド数、channels_last、"
+        "inference_mode、bf16、前処理）を計測し、最も速い設定を保存する"
+    )
+    parser.add_argument(
+        "--model",
+        default=None,
+        help="計測に使うモデル（省略時は最初のサイトの最初のモデル）",
+    )
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        nargs="*",
+        default=[1, 2, 4],
+        help="試す inter-op のスレッド数（値ごとにプロセスを分けて計測する）",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="計測結果を表示するだけで保存しない"
+    )
+    parser.add_argument("--worker", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    model_path = args.model
+    if model_path is None:
+        from utils.sites import get_site
+
+        model_path = next(iter(get_site().models_and_outputs))
+
+    if args.worker is not None:
+        best, results = tune_once(model_path, args.worker, args.iterations)
+        print(json.dumps({"best": best, "results": results}))
+        return
+
+    best = None
+    best_seconds = None
+    all_results = []
+    for inter_op_threads in args.inter_op_threads:
+        print(f"inter-op {inter_op_threads} スレッドで計測します")
+        completed = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--model",
+                model_path,
+                "--iterations",
+                str(args.iterations),
+                "--worker",
+                str(inter_op_threads),
+            ],
+            check=True,
+            # 計測中は保存済みの設定を使わない
+            env=dict(os.environ, CPU_TUNING="off"),
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        output = json.loads(completed.stdout.strip().splitlines()[-1])
+        all_results.extend(output["results"])
+        seconds = min(
+            result["seconds"]
+            for result in output["results"]
+            if result["settings"] == output["best"]
+        )
+        print(f"  最速: {seconds * 1000:.1f} ms {output['best']}")
+        if best_seconds is None or seconds < best_seconds:
+            best, best_seconds = output["best"], seconds
+
+    print(f"最も速い設定: {best} ({best_seconds * 1000:.1f} ms)")
+    if not args.dry_run:
+        from utils.cpu_tuning import tuning
+
+        tuning.save(best, all_results)
+        print(f"{tuning.path} に保存しました（ホスト: {tuning.host}）")
+
+
+if __name__ == "__main__":
+    main()
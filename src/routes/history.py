@@ -0,0 +1,23 @@
+from flask import request, jsonify
+from utils.history import GRANULARITIES, get_store
+
+
+# 例: /history?lot=takeda_a&start=2024-11-01&end=2024-11-08&granularity=hourly
+def history():
+    granularity = request.args.get("granularity", "raw")
+    if granularity != "raw" and granularity not in GRANULARITIES:
+        return jsonify({"error": f"Unknown granularity: {granularity}"}), 400
+
+    try:
+        limit = int(request.args.get("limit", 10000))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    rows = get_store().query(
+        lot=request.args.get("lot"),
+        start=request.args.get("start"),
+        end=request.args.get("end"),
+        granularity=granularity,
+        limit=limit,
+    )
+    return jsonify({"granularity": granularity, "history": rows}), 200
@@ -0,0 +1,7 @@
+from flask import Response
+from utils.metrics import metrics
+
+
+# Prometheus のテキスト形式で段階・駐車場ごとの処理時間と件数を返す
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
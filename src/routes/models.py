@@ -0,0 +1,6 @@
+from flask import jsonify
+from utils.model_registry import registry
+
+
+def model_status():
+    return jsonify({"models": registry.timings()}), 200
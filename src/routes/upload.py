@@ -1,22 +1,28 @@
 from flask import request, jsonify
-from utils.file import clear_existing_files, save_file
-from utils.image import split_image
+from utils.file import (
+    make_request_folder,
+    remove_request_folder,
+    save_bytes_async,
+    save_file,
+)
+from utils.image import decode_image, split_image, split_image_array
+from utils.inference_server import inference_server
+from utils.metrics import metrics
+from utils.result_cache import result_cache
+from utils.sites import get_site
 from utils.visistory_api import run_predictions
 import os
-
-
-# モデルファイル名と対応する出力名
-models_and_outputs = {
-    "models/parking_model_takeda_a.pth": "takeda_a.jpg",
-    "models/parking_model_takeda_b.pth": "takeda_b.jpg",
-    "models/parking_model_takeda_c.pth": "takeda_c.jpg",
-    "models/parking_model_takeda_d.pth": "takeda_d.jpg",
-    "models/parking_model_rittai_p.pth": "rittai_p.jpg",
-    "models/parking_model_bottom.pth": "bottom.jpg",
-}
+import time
 
 
 def upload_file():
+    # ?site= で対象のサイトを選ぶ（省略時は設定ファイルの最初のサイト）
+    try:
+        site = get_site(request.args.get("site"))
+    except KeyError as e:
+        return jsonify({"error": str(e.args[0])}), 404
+    models_and_outputs = site.models_and_outputs
+
     if "file" not in request.files:
         return jsonify({"error": "No file part in the request"}), 400
 
@@ -25,16 +31,56 @@ def upload_file():
         return jsonify({"error": "No selected file"}), 400
 
     if file:
+        request_folders = []
+        start = time.perf_counter()
         try:
-            folder = os.getenv("UPLOAD_FOLDER")
-            clear_existing_files(folder)
-            filename, filepath = save_file(file, folder)
-            segments = split_image(
-                filepath, os.getenv("TARGET_FOLDER"), models_and_outputs
+            # 同じサイト・同じ画像・同じモデルの組み合わせなら前回の結果をそのまま返す
+            data = file.read()
+            cache_key = result_cache.key(data, models_and_outputs, site.name)
+            results = result_cache.get(cache_key)
+            if results is not None:
+                metrics.inc("upload_cache_total", result="hit")
+                response = jsonify({"results": results})
+                response.headers["X-Cache"] = "HIT"
+                return response, 200
+
+            if os.getenv("UPLOAD_MODE", "memory") == "disk":
+                file.stream.seek(0)
+                # 同時リクエストで上書きし合わないようリクエストごとのフォルダを使う
+                folder = make_request_folder(os.getenv("UPLOAD_FOLDER"))
+                target_folder = make_request_folder(os.getenv("TARGET_FOLDER"))
+                request_folders = [folder, target_folder]
+                filename, filepath = save_file(file, folder)
+                segments = split_image(
+                    filepath, target_folder, models_and_outputs, site.layout
+                )
+            else:
+                # ディスクを介さずメモリ上でデコード・分割・前処理する
+                audit_folder = os.getenv("AUDIT_FOLDER")
+                if audit_folder:
+                    save_bytes_async(data, audit_folder)
+                segments = split_image_array(
+                    decode_image(data), models_and_outputs, site.layout
+                )
+            metrics.inc("upload_cache_total", result="miss")
+            results = run_predictions(
+                segments,
+                inference_server,
+                source="upload",
+                parking_lot_ids=site.parking_lot_ids,
             )
-            results = run_predictions(segments)
-            return jsonify({"results": results}), 200
+            result_cache.put(cache_key, results)
+            response = jsonify({"results": results})
+            response.headers["X-Cache"] = "MISS"
+            return response, 200
         except Exception as e:
+            metrics.inc("stage_errors_total", stage="upload")
             return jsonify({"error": str(e)}), 500
+        finally:
+            for request_folder in request_folders:
+                remove_request_folder(request_folder)
+            metrics.observe(
+                "stage_seconds", time.perf_counter() - start, stage="upload"
+            )
 
     return jsonify({"error": "File upload failed"}), 500
@@ -0,0 +1,153 @@
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from flask import Response, jsonify, request, stream_with_context
+from utils.file import is_image_name, iter_archive_images
+from utils.history import record_results
+from utils.image import decode_image, split_image_array
+from utils.inference_server import inference_server
+from utils.metrics import metrics
+from utils.model_registry import registry
+from utils.predict import predict_batch
+from utils.result_cache import result_cache
+from utils.sites import get_site
+import json
+import os
+
+ARCHIVE_TYPES = {
+    "application/zip": "zip",
+    "application/x-zip-compressed": "zip",
+    "application/x-tar": "tar",
+    "application/gzip": "tar",
+    "application/x-gzip": "tar",
+    "application/x-gtar": "tar",
+}
+
+
+# リクエストに含まれる画像を1枚ずつ (名前, バイト列) で返す
+# multipart の場合は files（または file）の全ファイル、本文がアーカイブの場合はその中の画像
+def iter_request_images():
+    kind = ARCHIVE_TYPES.get(request.mimetype)
+    if kind is not None:
+        yield from iter_archive_images(request.stream, kind)
+        return
+
+    for field in ("files", "file"):
+        for file in request.files.getlist(field):
+            if not file.filename:
+                continue
+            kind = ARCHIVE_TYPES.get(file.mimetype)
+            if kind is not None:
+                yield from iter_archive_images(file.stream, kind)
+            elif is_image_name(file.filename) or file.mimetype.startswith("image/"):
+                yield file.filename, file.read()
+
+
+# 推論サーバーに渡す（同時に送った他の画像や他のリクエストとまとめてバッチ推論される）
+# サーバーが動いていない場合はその場で推論し、完了済みの Future を返す
+def submit(segments):
+    if inference_server.running:
+        return inference_server.submit(segments)
+    future = Future()
+    try:
+        ensemble, device = registry.get_ensemble(
+            [model_path for _, model_path, _ in segments]
+        )
+        statuses = predict_batch(
+            [segment for segment, _, _ in segments], ensemble, device
+        )
+        future.set_result(
+            {
+                output_name: status
+                for (_, _, output_name), status in zip(segments, statuses)
+            }
+        )
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def upload_batch():
+    try:
+        site = get_site(request.args.get("site"))
+    except KeyError as e:
+        return jsonify({"error": str(e.args[0])}), 404
+    models_and_outputs = site.models_and_outputs
+    # 同時に推論へ渡す画像の上限（これを超えたら完了を待ってから次の画像を読む）
+    try:
+        window = max(
+            1, int(request.args.get("window", os.getenv("BATCH_UPLOAD_WINDOW", "8")))
+        )
+    except ValueError:
+        return jsonify({"error": "window must be an integer"}), 400
+    # record=1 のときだけ予測結果を履歴に残す（Visitory への送信は行わない）
+    record = request.args.get("record") == "1"
+
+    if request.mimetype not in ARCHIVE_TYPES and not request.files:
+        return jsonify({"error": "No files or archive in the request"}), 400
+
+    def line(entry):
+        return json.dumps(entry, ensure_ascii=False) + "\n"
+
+    def finish(future, index, name, cache_key):
+        try:
+            results = future.result()
+        except Exception as e:
+            metrics.inc("stage_errors_total", stage="upload_batch")
+            return line({"index": index, "name": name, "error": str(e)})
+        result_cache.put(cache_key, results)
+        if record:
+            record_results(results, source="upload_batch")
+        return line({"index": index, "name": name, "results": results})
+
+    def generate():
+        # Future -> (番号, 名前, キャッシュのキー)
+        in_flight = {}
+        count = 0
+
+        def drain(limit):
+            while len(in_flight) > limit:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield finish(future, *in_flight.pop(future))
+
+        with metrics.timer("upload_batch"):
+            try:
+                for index, (name, data) in enumerate(iter_request_images()):
+                    count += 1
+                    cache_key = result_cache.key(data, models_and_outputs, site.name)
+                    results = result_cache.get(cache_key)
+                    if results is not None:
+                        metrics.inc("upload_cache_total", result="hit")
+                        yield line(
+                            {
+                                "index": index,
+                                "name": name,
+                                "results": results,
+                                "cached": True,
+                            }
+                        )
+                        continue
+                    metrics.inc("upload_cache_total", result="miss")
+
+                    try:
+                        image = decode_image(data)
+                        segments = split_image_array(
+                            image, models_and_outputs, site.layout
+                        )
+                        in_flight[submit(segments)] = (index, name, cache_key)
+                    except Exception as e:
+                        metrics.inc("stage_errors_total", stage="upload_batch")
+                        yield line({"index": index, "name": name, "error": str(e)})
+
+                    # 処理中の画像が上限に達したら、終わったものから結果を返す
+                    yield from drain(window - 1)
+            except Exception as e:
+                # 壊れたアーカイブ等で読み込みを続けられない場合も、処理中の結果は返す
+                yield from drain(0)
+                yield line({"error": f"Failed to read upload: {e}"})
+                return
+
+            yield from drain(0)
+
+        metrics.inc("upload_batch_images_total", count)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
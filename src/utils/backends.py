@@ -0,0 +1,141 @@
+import os
+
+import torch
+
+# 推論バックエンド
+# eager: 学習時と同じ float32 の PyTorch モデル（.pth）
+# torchscript / int8_dynamic / int8_static: TorchScript 形式に書き出したモデル
+# onnx: ONNX Runtime で実行するモデル
+BACKENDS = ("eager", "torchscript", "onnx", "int8_dynamic", "int8_static")
+
+ARTIFACT_SUFFIXES = {
+    "eager": ".pth",
+    "torchscript": ".ts.pt",
+    "onnx": ".onnx",
+    "int8_dynamic": ".int8_dynamic.pt",
+    "int8_static": ".int8_static.pt",
+}
+
+if hasattr(torch, "ao") and hasattr(torch.ao, "quantization"):
+    quantization = torch.ao.quantization
+else:
+    quantization = torch.quantization
+
+
+# eager でメモリマップして読み込む重みファイル（utils/checkpoint.py の形式）
+CHECKPOINT_SUFFIX = ".safetensors"
+
+
+def checkpoint_path(model_path):
+    return os.path.splitext(model_path)[0] + CHECKPOINT_SUFFIX
+
+
+# models/parking_model_xxx.pth に対応するバックエンドごとのファイルパス
+# eager は .safetensors があり、.pth より古くなければそちらを使う
+def artifact_path(model_path, backend):
+    if backend not in ARTIFACT_SUFFIXES:
+        raise ValueError(f"Unknown inference backend: {backend}")
+    # 共有バックボーンのモデル（path#駐車場名）はバックエンドによらず同じファイル
+    path, _, lot = model_path.partition("#")
+    if lot:
+        return path
+    base, _ = os.path.splitext(model_path)
+    path = base + ARTIFACT_SUFFIXES[backend]
+    if backend == "eager":
+        mmap_path = checkpoint_path(model_path)
+        try:
+            if os.path.getmtime(mmap_path) >= os.path.getmtime(path):
+                return mmap_path
+        except OSError:
+            if os.path.exists(mmap_path):
+                return mmap_path
+    return path
+
+
+# ONNX Runtime のセッションを PyTorch モデルと同じように呼び出せるようにする
+class OnnxModel:
+    def __init__(self, path, intra_op_num_threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError(
+                "onnx backend requires onnxruntime (pip install onnxruntime)"
+            )
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        if intra_op_num_threads:
+            options.intra_op_num_threads = intra_op_num_threads
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, images):
+        outputs = self.session.run(None, {self.input_name: images.cpu().numpy()})
+        return torch.from_numpy(outputs[0])
+
+    def eval(self):
+        return self
+
+
+# 書き出し済みのモデルを読み込む（量子化モデルと ONNX は CPU で実行する）
+def load_backend(model_path, backend, device):
+    path = artifact_path(model_path, backend)
+    if backend == "onnx":
+        return OnnxModel(path), torch.device("cpu")
+    if backend in ("int8_dynamic", "int8_static"):
+        device = torch.device("cpu")
+    model = torch.jit.load(path, map_location=device)
+    model.eval()
+    return model, device
+
+
+def export_torchscript(model, path):
+    example = torch.zeros(1, 3, 224, 224)
+    traced = torch.jit.trace(model.cpu().eval(), example)
+    traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return path
+
+
+def export_onnx(model, path):
+    example = torch.zeros(1, 3, 224, 224)
+    torch.onnx.export(
+        model.cpu().eval(),
+        example,
+        path,
+        input_names=["images"],
+        output_names=["logits"],
+        dynamic_axes={"images": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=13,
+    )
+    return path
+
+
+# 全結合層のみを int8 に動的量子化する
+def export_int8_dynamic(model, path):
+    quantized = quantization.quantize_dynamic(
+        model.cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return export_torchscript(quantized, path)
+
+
+# 畳み込み層も含めて int8 に静的量子化する（calibration_batches で活性値の範囲を推定）
+def export_int8_static(model, path, calibration_batches):
+    from torchvision.models.quantization import resnet18 as quantizable_resnet18
+
+    qmodel = quantizable_resnet18(weights=None, quantize=False)
+    qmodel.fc = torch.nn.Linear(qmodel.fc.in_features, 3)
+    qmodel.load_state_dict(model.cpu().state_dict())
+    qmodel.eval()
+    qmodel.fuse_model()
+    qmodel.qconfig = quantization.get_default_qconfig("fbgemm")
+    quantization.prepare(qmodel, inplace=True)
+    with torch.no_grad():
+        for images in calibration_batches:
+            qmodel(images)
+    quantization.convert(qmodel, inplace=True)
+    return export_torchscript(qmodel, path)
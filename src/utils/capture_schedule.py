@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from utils.metrics import metrics
+
+# 変化がなかった場合に取得間隔を何倍に延ばすか
+DEFAULT_BACKOFF = 2.0
+# セグメントの画素値（0-255）の平均絶対差がこれを超えたら変化ありとみなす
+DEFAULT_ACTIVITY_THRESHOLD = 4.0
+# 待機中もこの秒数ごとに間隔を計算し直す（短縮や時間帯の切り替えをすぐ反映する）
+POLL_SECONDS = 10
+# 実効サンプリングレートを求める期間（秒）
+RATE_WINDOW = 3600
+
+
+# "07:30" -> 0時からの分数
+def parse_time(value):
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+# 時間帯ごとの取得間隔の範囲（start > end なら日付をまたぐ。例: 22:00-06:00）
+class Profile:
+    def __init__(self, config, min_interval, max_interval):
+        self.start = parse_time(config["start"])
+        self.end = parse_time(config["end"])
+        self.min_interval = config.get("min_interval", min_interval)
+        self.max_interval = config.get("max_interval", max_interval)
+        if self.min_interval > self.max_interval:
+            raise ValueError(f"min_interval > max_interval in profile {config}")
+
+    def contains(self, moment):
+        minute = moment.hour * 60 + moment.minute
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+
+# 駐車場の変化に合わせて取得間隔を変えるスケジューラ（サイトごとに1つ）
+# 予測結果が前回から変わった区画がある、またはセグメントの画素の差が閾値を超えた場合は最短間隔に戻し、
+# 変化がなければ backoff 倍ずつ最長間隔まで延ばす。範囲は時間帯（profiles）ごとに変えられる
+# min_interval / max_interval を省略すると interval の固定間隔になる（従来の動作）
+class CaptureScheduler:
+    def __init__(
+        self,
+        interval,
+        min_interval=None,
+        max_interval=None,
+        backoff=DEFAULT_BACKOFF,
+        activity_threshold=DEFAULT_ACTIVITY_THRESHOLD,
+        profiles=(),
+        name=None,
+    ):
+        self.name = name
+        self.min_interval = min_interval or interval
+        self.max_interval = max_interval or interval
+        if self.min_interval > self.max_interval:
+            raise ValueError("min_interval must not exceed max_interval")
+        self.backoff = backoff
+        self.activity_threshold = activity_threshold
+        self.profiles = [
+            Profile(profile, self.min_interval, self.max_interval)
+            for profile in profiles
+        ]
+        self._lock = threading.Lock()
+        self._interval = interval
+        self._statuses = {}
+        self._captures = deque()
+        self._started = time.time()
+
+    # サイトの設定の "schedule" から作る（interval を指定した場合はその固定間隔）
+    @classmethod
+    def from_site(cls, site, interval=None):
+        if interval is not None:
+            return cls(interval, name=site.name)
+        config = site.schedule
+        return cls(
+            site.interval,
+            min_interval=config.get("min_interval"),
+            max_interval=config.get("max_interval"),
+            backoff=config.get("backoff", DEFAULT_BACKOFF),
+            activity_threshold=config.get(
+                "activity_threshold", DEFAULT_ACTIVITY_THRESHOLD
+            ),
+            profiles=config.get("profiles", []),
+            name=site.name,
+        )
+
+    # 現在時刻の時間帯の (最短, 最長) 間隔
+    def bounds(self, moment=None):
+        moment = moment or datetime.now()
+        for profile in self.profiles:
+            if profile.contains(moment):
+                return profile.min_interval, profile.max_interval
+        return self.min_interval, self.max_interval
+
+    @property
+    def interval(self):
+        low, high = self.bounds()
+        with self._lock:
+            return min(max(self._interval, low), high)
+
+    # 1フレーム分の予測結果（区画 -> 状態）と画素の差（区画ごとの最大値）から間隔を更新する
+    # 戻り値: 変化があったか
+    def observe(self, statuses=None, difference=None):
+        low, high = self.bounds()
+        with self._lock:
+            changed = [
+                name
+                for name, status in (statuses or {}).items()
+                if self._statuses.get(name, status) != status
+            ]
+            self._statuses.update(statuses or {})
+            active = bool(changed) or (
+                difference is not None and difference > self.activity_threshold
+            )
+            current = min(max(self._interval, low), high)
+            if active:
+                self._interval = low
+            else:
+                self._interval = min(current * self.backoff, high)
+            interval = self._interval
+        if interval != current:
+            reason = f"変化あり {changed}" if active else "変化なし"
+            print(f"{self.name}: 取得間隔 {current:.0f}秒 -> {interval:.0f}秒 ({reason})")
+        return active
+
+    def record_capture(self, at=None):
+        at = at or time.time()
+        with self._lock:
+            self._captures.append(at)
+            while self._captures and self._captures[0] <= at - RATE_WINDOW:
+                self._captures.popleft()
+        metrics.inc("captures_total", site=self.name)
+
+    # 直近 RATE_WINDOW 秒の実効サンプリングレート（フレーム/時）
+    def effective_rate(self):
+        now = time.time()
+        with self._lock:
+            count = sum(1 for at in self._captures if at > now - RATE_WINDOW)
+        elapsed = min(RATE_WINDOW, max(now - self._started, 1))
+        return count * 3600 / elapsed
+
+    # 取得時刻（壁時計）を返すジェネレータ
+    # 最初は interval 秒の倍数ちょうど、以降は前回の取得から現在の間隔だけ空けて発火する
+    # 処理が遅れて周期を飛ばした場合は、次の周期から再開する
+    def ticks(self, stop_event):
+        last_tick = None
+        last_interval = None
+        while not stop_event.is_set():
+            interval = self.interval
+            now = time.time()
+            if last_tick is None:
+                next_tick = (now // interval + 1) * interval
+            else:
+                next_tick = last_tick + interval
+                if next_tick <= now:
+                    skipped = int((now - next_tick) // interval) + 1
+                    if interval == last_interval:
+                        print(f"処理が間に合わず {skipped} 周期をスキップしました")
+                    next_tick += skipped * interval
+            delay = next_tick - now
+            if delay > 0 and stop_event.wait(min(delay, POLL_SECONDS)):
+                break
+            if delay > POLL_SECONDS:
+                continue
+            last_tick, last_interval = next_tick, interval
+            self.record_capture(next_tick)
+            yield next_tick
@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+
+# 駐車場ごとに前回のセグメントの縮小グレースケール画像を覚えておき、
+# 新しいセグメントとの差が閾値以内なら前回の予測結果を再利用する
+class ChangeDetector:
+    def __init__(self, threshold=4.0, size=(32, 16), max_age=3600, state_path=None):
+        # threshold: 画素値（0-255）の平均絶対差
+        # max_age: この秒数を超えたら変化がなくても推論し直す
+        self.threshold = threshold
+        self.size = size
+        self.max_age = max_age
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        # output_name -> (signature, status, 推論した時刻)
+        self._entries = {}
+        self.hits = {}
+        self.misses = {}
+        self._load_state()
+
+    def signature(self, segment):
+        if isinstance(segment, np.ndarray):
+            image = Image.fromarray(segment)
+        else:
+            image = Image.open(segment)
+        with image:
+            small = image.convert("L").resize(self.size, Image.BILINEAR)
+        return np.asarray(small, dtype=np.float32)
+
+    # 変化がなければ前回の状態を返す（変化があれば None）
+    def lookup(self, output_name, signature):
+        with self._lock:
+            entry = self._entries.get(output_name)
+            if entry is not None:
+                previous, status, predicted_at = entry
+                age = time.time() - predicted_at
+                fresh = self.max_age is None or age < self.max_age
+                if (
+                    fresh
+                    and previous.shape == signature.shape
+                    and float(np.abs(previous - signature).mean()) <= self.threshold
+                ):
+                    self.hits[output_name] = self.hits.get(output_name, 0) + 1
+                    return status
+            self.misses[output_name] = self.misses.get(output_name, 0) + 1
+            return None
+
+    # 前回推論したときのセグメントとの差（画素値の平均絶対差、前回がなければ None）
+    def difference(self, output_name, signature):
+        with self._lock:
+            entry = self._entries.get(output_name)
+        if entry is None or entry[0].shape != signature.shape:
+            return None
+        return float(np.abs(entry[0] - signature).mean())
+
+    def update(self, output_name, signature, status):
+        with self._lock:
+            self._entries[output_name] = (signature, status, time.time())
+
+    def stats(self):
+        with self._lock:
+            names = sorted(set(self.hits) | set(self.misses))
+            lots = {
+                name: {
+                    "hits": self.hits.get(name, 0),
+                    "misses": self.misses.get(name, 0),
+                }
+                for name in names
+            }
+            hits = sum(self.hits.values())
+            misses = sum(self.misses.values())
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "lots": lots,
+        }
+
+    # cron で毎回起動する場合にも使えるよう、状態をファイルに保存・復元する
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        for output_name, entry in state.items():
+            signature = np.array(entry["signature"], dtype=np.float32)
+            self._entries[output_name] = (
+                signature,
+                entry["status"],
+                entry["predicted_at"],
+            )
+
+    def save_state(self):
+        if not self.state_path:
+            return
+        with self._lock:
+            state = {
+                output_name: {
+                    "signature": signature.tolist(),
+                    "status": status,
+                    "predicted_at": predicted_at,
+                }
+                for output_name, (
+                    signature,
+                    status,
+                    predicted_at,
+                ) in self._entries.items()
+            }
+            # 複数のスレッドから呼ばれても一時ファイルを取り合わないよう、書き込みもロック内で行う
+            os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
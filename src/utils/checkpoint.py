@@ -0,0 +1,111 @@
+import json
+import os
+import struct
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+# モデルの重みを保存するファイル形式（safetensors 互換）
+#   先頭 8 バイト: ヘッダー長（リトルエンディアンの uint64）
+#   ヘッダー: JSON {テンソル名: {"dtype", "shape", "data_offsets"}, "__metadata__": {...}}
+#   以降: 各テンソルの生データ（ヘッダー直後からのオフセット）
+# 読み込み時はファイルをメモリマップし、テンソルはその上のビューにする（コピーしない）
+
+# safetensors の型名 -> (NumPy の型, PyTorch の型)
+# bfloat16 は NumPy にないため int16 として読み、PyTorch 側で型を読み替える
+DTYPES = {
+    "F64": (np.float64, torch.float64),
+    "F32": (np.float32, torch.float32),
+    "F16": (np.float16, torch.float16),
+    "BF16": (np.int16, torch.bfloat16),
+    "I64": (np.int64, torch.int64),
+    "I32": (np.int32, torch.int32),
+    "I16": (np.int16, torch.int16),
+    "I8": (np.int8, torch.int8),
+    "U8": (np.uint8, torch.uint8),
+    "BOOL": (np.bool_, torch.bool),
+}
+TORCH_DTYPES = {torch_dtype: name for name, (_, torch_dtype) in DTYPES.items()}
+
+
+def save_checkpoint(path, state_dict, metadata=None):
+    tensors = []
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        if tensor.dtype not in TORCH_DTYPES:
+            raise ValueError(f"Unsupported dtype for {name}: {tensor.dtype}")
+        tensors.append((name, tensor))
+    # 要素サイズの大きい順に並べ、各テンソルの先頭が要素サイズの倍数になるようにする
+    tensors.sort(key=lambda item: (-item[1].element_size(), item[0]))
+
+    header = {}
+    offset = 0
+    for name, tensor in tensors:
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": TORCH_DTYPES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + size],
+        }
+        offset += size
+    if metadata:
+        header["__metadata__"] = {key: str(value) for key, value in metadata.items()}
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # データの先頭を 8 バイト境界に揃える（safetensors と同じく空白で埋める）
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for _, tensor in tensors:
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            f.write(tensor.numpy().tobytes())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _read_header(f):
+    (header_length,) = struct.unpack("<Q", f.read(8))
+    header = json.loads(f.read(header_length))
+    return header_length, header
+
+
+# ヘッダーだけを読む（アーキテクチャやクラスの対応の確認用）
+def read_metadata(path):
+    with open(path, "rb") as f:
+        _, header = _read_header(f)
+    return header.get("__metadata__", {})
+
+
+# テンソルはファイルを copy-on-write でメモリマップしたビューとして返す
+# 書き換えない限り複数プロセスで同じページを共有し、読み込み時のコピーも発生しない
+def load_checkpoint(path):
+    with open(path, "rb") as f:
+        header_length, header = _read_header(f)
+    metadata = header.pop("__metadata__", {})
+
+    data_size = max((info["data_offsets"][1] for info in header.values()), default=0)
+    buffer = None
+    if data_size:
+        buffer = np.memmap(
+            path, dtype=np.uint8, mode="c", offset=8 + header_length, shape=(data_size,)
+        )
+
+    state_dict = OrderedDict()
+    for name, info in header.items():
+        np_dtype, torch_dtype = DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            state_dict[name] = torch.empty(info["shape"], dtype=torch_dtype)
+            continue
+        count = (end - begin) // np.dtype(np_dtype).itemsize
+        array = np.frombuffer(buffer, np_dtype, count, begin).reshape(info["shape"])
+        tensor = torch.from_numpy(array)
+        if torch_dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        state_dict[name] = tensor
+    return state_dict, metadata
@@ -0,0 +1,271 @@
+import copy
+import json
+import os
+import platform
+import socket
+import statistics
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+
+import numpy as np
+import torch
+
+# CPU での推論の設定。None は PyTorch の既定のまま（チューニング前の従来の動作）
+DEFAULT_SETTINGS = {
+    "intra_op_threads": None,
+    "inter_op_threads": None,
+    "channels_last": False,
+    "inference_mode": False,
+    "bf16": False,
+    "fused_preprocess": False,
+}
+
+# 真偽値の設定を1つずつ切り替えて試す順番
+TOGGLES = ["fused_preprocess", "channels_last", "inference_mode", "bf16"]
+
+# 切り替えた方がこの割合以上速い場合だけ採用する（計測の揺らぎで設定が変わらないように）
+MIN_IMPROVEMENT = 0.03
+
+
+# このマシンを識別する情報（変わった場合は保存済みの設定を使わない）
+def host_fingerprint():
+    return {
+        "cpu_count": os.cpu_count(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "torch": torch.__version__,
+    }
+
+
+# 候補のスレッド数（1, 2, 4, ... と CPU 数）
+def thread_candidates(cpu_count=None):
+    cpu_count = cpu_count or os.cpu_count() or 1
+    candidates = {cpu_count}
+    n = 1
+    while n < cpu_count:
+        candidates.add(n)
+        n *= 2
+    return sorted(candidates)
+
+
+# CPU が bfloat16 の自動混合精度で ResNet を実行できるか
+def bf16_supported():
+    try:
+        conv = torch.nn.Conv2d(3, 8, 3)
+        with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+            conv(torch.zeros(1, 3, 8, 8))
+        return True
+    except (AttributeError, RuntimeError, TypeError):
+        return False
+
+
+# ホストごとの推論設定を保存ファイル（CPU_TUNING_FILE）から読み込み、推論の各所に適用する
+# CPU_TUNING: off（従来の動作）/ saved（保存済みの設定を使う、既定）/ auto（未計測なら起動時に計測して保存）
+class CpuTuning:
+    def __init__(self, path=None, mode=None):
+        self._path = path
+        self._mode = mode
+        self._lock = threading.RLock()
+        self._settings = None
+        self._applied = False
+
+    @property
+    def path(self):
+        return self._path or os.getenv("CPU_TUNING_FILE", "data/cpu_tuning.json")
+
+    @property
+    def mode(self):
+        return self._mode or os.getenv("CPU_TUNING", "saved")
+
+    @property
+    def host(self):
+        return socket.gethostname()
+
+    # 現在の設定（初回に保存ファイルから読み込む。スレッド数は configure で適用する）
+    @property
+    def settings(self):
+        with self._lock:
+            if self._settings is None:
+                self._settings = dict(DEFAULT_SETTINGS)
+                if self.mode != "off":
+                    self._settings.update(self.load() or {})
+            return self._settings
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entry = json.load(f).get("hosts", {}).get(self.host)
+        except (OSError, ValueError):
+            return None
+        if entry is None:
+            return None
+        if entry.get("fingerprint") != host_fingerprint():
+            print(f"CPU またはPyTorch が変わったため {self.path} の設定を使いません")
+            return None
+        return {
+            key: value
+            for key, value in entry.get("settings", {}).items()
+            if key in DEFAULT_SETTINGS
+        }
+
+    # ホストごとの設定を追記する（他のホストの設定は残す）
+    def save(self, settings, results=None):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        data.setdefault("hosts", {})[self.host] = {
+            "fingerprint": host_fingerprint(),
+            "settings": settings,
+            "results": results or [],
+            "tuned_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+        with self._lock:
+            self._settings = dict(DEFAULT_SETTINGS, **settings)
+            self._applied = False
+
+    # スレッド数を適用する（inter-op はプロセスで並列処理が始まる前にしか変更できない）
+    def configure(self):
+        with self._lock:
+            settings = self.settings
+            if self._applied:
+                return settings
+            self._applied = True
+            if settings["intra_op_threads"]:
+                torch.set_num_threads(settings["intra_op_threads"])
+            if settings["inter_op_threads"]:
+                try:
+                    torch.set_num_interop_threads(settings["inter_op_threads"])
+                except RuntimeError:
+                    if torch.get_num_interop_threads() != settings["inter_op_threads"]:
+                        print("inter-op のスレッド数は起動直後にしか変更できません")
+            return settings
+
+    # ロードしたモデルを設定に合わせる（channels_last は PyTorch のモデルを CPU で使う場合だけ）
+    def prepare_model(self, model, device, settings=None):
+        settings = settings or self.settings
+        if (
+            settings["channels_last"]
+            and torch.device(device).type == "cpu"
+            and isinstance(model, torch.nn.Module)
+            and not isinstance(model, torch.jit.ScriptModule)
+        ):
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+    def prepare_input(self, images, settings=None):
+        settings = settings or self.settings
+        if settings["channels_last"] and images.device.type == "cpu":
+            return images.contiguous(memory_format=torch.channels_last)
+        return images
+
+    # 推論時のコンテキスト（inference_mode または no_grad、CPU なら bf16 の自動混合精度）
+    @contextmanager
+    def inference_context(self, device="cpu", settings=None):
+        settings = settings or self.settings
+        with ExitStack() as stack:
+            if settings["inference_mode"] and hasattr(torch, "inference_mode"):
+                stack.enter_context(torch.inference_mode())
+            else:
+                stack.enter_context(torch.no_grad())
+            if settings["bf16"] and torch.device(device).type == "cpu":
+                stack.enter_context(torch.autocast("cpu", dtype=torch.bfloat16))
+            yield
+
+    # CPU_TUNING=auto で、このホストの設定が未保存ならモデルを使って計測し保存する
+    def ensure_tuned(self, model, device):
+        if self.mode != "auto" or torch.device(device).type != "cpu":
+            return False
+        if not isinstance(model, torch.nn.Module):
+            return False
+        with self._lock:
+            if self.load() is not None:
+                return False
+            print("このホストの推論設定を計測します（CPU_TUNING=auto）")
+            best, results = autotune(model, device, self)
+            self.save(best, results)
+            self.configure()
+            print(f"推論設定を {self.path} に保存しました: {best}")
+            return True
+
+
+# セグメント画像の代わりに使う uint8 の画像（分割後の大きさはまちまちなので数種類）
+def sample_segments(count=6, seed=0):
+    rng = np.random.default_rng(seed)
+    sizes = [(180, 320), (240, 240), (360, 480)]
+    return [
+        rng.integers(0, 256, (*sizes[i % len(sizes)], 3), dtype=np.uint8)
+        for i in range(count)
+    ]
+
+
+# 設定ごとに「前処理 + 推論」の処理時間（中央値）を計る
+# スレッド数を総当たりしたあと、真偽値の設定を1つずつ切り替えて速くなるものを採用する
+# （inter-op のスレッド数は起動後に変更できないため、batch/tune_cpu.py でプロセスを分けて計る）
+def autotune(model, device, tuning, segments=None, iterations=10, threads=None):
+    from utils.predict import preprocess_batch
+
+    segments = segments if segments is not None else sample_segments()
+    results = []
+    models = {}
+    original_threads = torch.get_num_threads()
+
+    def measure(settings):
+        key = settings["channels_last"]
+        if key not in models:
+            models[key] = tuning.prepare_model(copy.deepcopy(model), device, settings)
+        candidate = models[key]
+        torch.set_num_threads(settings["intra_op_threads"])
+
+        def run():
+            images = preprocess_batch(segments, device, settings)
+            with tuning.inference_context(device, settings):
+                return candidate(images).float()
+
+        outputs = run()
+        run()
+        seconds = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - start)
+        median = statistics.median(seconds)
+        results.append({"settings": dict(settings), "seconds": median})
+        print(f"  {median * 1000:.1f} ms: {settings}")
+        return median, outputs
+
+    try:
+        best = dict(DEFAULT_SETTINGS)
+        best["inter_op_threads"] = torch.get_num_interop_threads()
+        best_seconds = reference = None
+        for n in threads or thread_candidates():
+            settings = dict(best, intra_op_threads=n)
+            seconds, outputs = measure(settings)
+            if best_seconds is None or seconds < best_seconds:
+                best, best_seconds, reference = settings, seconds, outputs
+
+        for toggle in TOGGLES:
+            if toggle == "bf16" and not bf16_supported():
+                continue
+            settings = dict(best, **{toggle: not best[toggle]})
+            seconds, outputs = measure(settings)
+            # 予測ラベルが変わる設定（bf16 など）は採用しない
+            if not torch.equal(outputs.argmax(1), reference.argmax(1)):
+                print(f"  {toggle} で予測が変わるため採用しません")
+                continue
+            if seconds < best_seconds * (1 - MIN_IMPROVEMENT):
+                best, best_seconds = settings, seconds
+    finally:
+        torch.set_num_threads(original_threads)
+    return best, results
+
+
+tuning = CpuTuning()
@@ -1,6 +1,28 @@
 import os
+import shutil
+import tarfile
+import tempfile
 import uuid
 import glob
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# 監査用の保存はリクエスト処理を待たせないよう別スレッドで行う
+_persist_executor = ThreadPoolExecutor(max_workers=1)
+
+
+# 収集したフレームの相対パスから取得時刻を求める（形式が違えば更新時刻）
+# data/train/processed/2024/11/06/frame_123456.jpg -> 2024-11-06T12:34:56
+def frame_timestamp(frame, filepath):
+    try:
+        date_part, filename = os.path.split(frame)
+        time_part = os.path.splitext(filename)[0].replace("frame_", "")
+        return datetime.strptime(
+            f"{date_part.replace(os.sep, '/')} {time_part}", "%Y/%m/%d %H%M%S"
+        ).isoformat()
+    except ValueError:
+        return datetime.fromtimestamp(os.path.getmtime(filepath)).isoformat()
 
 
 def clear_existing_files(folder):
@@ -8,8 +30,64 @@ def clear_existing_files(folder):
         os.remove(existing_file)
 
 
+# リクエストごとの作業フォルダ（同時リクエスト間でファイルが衝突しないようにする）
+def make_request_folder(base_folder):
+    folder = os.path.join(base_folder, str(uuid.uuid4()))
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def remove_request_folder(folder):
+    shutil.rmtree(folder, ignore_errors=True)
+
+
 def save_file(file, folder):
     filename = f"{uuid.uuid4()}.png"
     filepath = os.path.join(folder, filename)
     file.save(filepath)
     return filename, filepath
+
+
+def _write_bytes(data, filepath):
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, "wb") as f:
+        f.write(data)
+    return filepath
+
+
+def save_bytes_async(data, folder, filename=None):
+    if filename is None:
+        filename = f"{uuid.uuid4()}.png"
+    filepath = os.path.join(folder, filename)
+    return _persist_executor.submit(_write_bytes, data, filepath)
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+# zip は末尾の目次を読む必要があるため、この大きさを超えたら一時ファイルに書き出す
+ARCHIVE_SPOOL_SIZE = 32 * 1024 * 1024
+
+
+def is_image_name(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+# アーカイブ（zip / tar、tar は gzip 等の圧縮も可）に含まれる画像を1枚ずつ (名前, バイト列) で返す
+# tar はストリームのまま先頭から読み、全体をメモリに載せない
+def iter_archive_images(stream, kind):
+    if kind == "tar":
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            for member in archive:
+                if member.isfile() and is_image_name(member.name):
+                    yield member.name, archive.extractfile(member).read()
+        return
+
+    if kind != "zip":
+        raise ValueError(f"Unsupported archive type: {kind}")
+    with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE) as spool:
+        shutil.copyfileobj(stream, spool)
+        spool.seek(0)
+        with zipfile.ZipFile(spool) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and is_image_name(info.filename):
+                    yield info.filename, archive.read(info)
@@ -0,0 +1,362 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tarfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_ARCHIVE_DIR = "data/archive"
+# 1つのシャードの最大サイズ（超えたら次のシャードに切り替える）
+DEFAULT_SHARD_SIZE = 1024 * 1024 * 1024
+TAR_BLOCK = 512
+
+
+# 取得したフレームを少数の大きなシャード（tar）にまとめて保存するアーカイブ
+#   shards/shard-000000.tar  フレームの JPEG をそのまま追記する（WebDataset と同じく
+#                            <ハッシュ>.jpg と <ハッシュ>.json のメンバーで、tar として読める）
+#   index.sqlite             ハッシュ -> シャード内の位置、取得時刻 -> ハッシュと切り出し範囲
+# 同じ内容のフレーム（SHA-256 が同じ）は1回だけ保存し、取得時刻の記録だけを追加する
+# 各駐車場の切り出し画像は保存せず、切り出し範囲（画素の矩形）をメタデータとして持つ
+class FrameArchive:
+    def __init__(self, root=None, shard_size=DEFAULT_SHARD_SIZE):
+        self.root = root or os.getenv("FRAME_ARCHIVE", DEFAULT_ARCHIVE_DIR)
+        self.shard_size = shard_size
+        self.shard_dir = os.path.join(self.root, "shards")
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # 他のプロセスが書き込み中の場合は、ロックが外れるまで待つ
+        self._conn = sqlite3.connect(
+            os.path.join(self.root, "index.sqlite"),
+            timeout=60,
+            check_same_thread=False,
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS shards (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                frames INTEGER NOT NULL,
+                sealed INTEGER NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                shard TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS captures (
+                site TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                rects TEXT,
+                source TEXT,
+                PRIMARY KEY (site, timestamp)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS captures_timestamp ON captures (timestamp)"
+        )
+        self._conn.commit()
+        self._file = None
+        self._shard = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # フレーム（JPEG などのエンコード済みバイト列）を追加する
+    # rects: {駐車場名: [x0, y0, x1, y1]}（元のフレームの画素）
+    # 戻り値: (ハッシュ, 新しく保存したか)。同じ内容のフレームは保存せず取得時刻だけ記録する
+    def add(self, data, timestamp, site="", rects=None, source=None):
+        key = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            stored = self._conn.execute(
+                "SELECT 1 FROM blobs WHERE hash = ?", (key,)
+            ).fetchone()
+            if stored is None:
+                # 画像の大きさは索引のロックを取る前に求めておく
+                with Image.open(io.BytesIO(data)) as image:
+                    width, height = image.size
+            with self._write_transaction():
+                # ロックを取るまでに他のプロセスが同じフレームを保存した場合は記録だけにする
+                stored = self._conn.execute(
+                    "SELECT 1 FROM blobs WHERE hash = ?", (key,)
+                ).fetchone()
+                if stored is None:
+                    metadata = {
+                        "timestamp": timestamp,
+                        "site": site,
+                        "width": width,
+                        "height": height,
+                        "rects": rects,
+                        "source": source,
+                    }
+                    shard, offset = self._append(key, data, metadata)
+                    self._conn.execute(
+                        "INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, shard, offset, len(data), width, height),
+                    )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO captures VALUES (?, ?, ?, ?, ?)",
+                    (
+                        site,
+                        timestamp,
+                        key,
+                        json.dumps(rects) if rects is not None else None,
+                        source,
+                    ),
+                )
+        return key, stored is None
+
+    def add_file(self, path, timestamp, site="", rects=None, source=None):
+        with open(path, "rb") as f:
+            data = f.read()
+        return self.add(data, timestamp, site, rects, source or path)
+
+    # フレームの配列を JPEG にエンコードして追加する（同じ画素なら同じバイト列になる）
+    def add_array(self, array, timestamp, site="", rects=None, source=None, quality=90):
+        buffer = io.BytesIO()
+        Image.fromarray(array).save(buffer, format="JPEG", quality=quality)
+        return self.add(buffer.getvalue(), timestamp, site, rects, source)
+
+    # 索引の書き込みのトランザクション
+    # BEGIN IMMEDIATE で最初に書き込みのロックを取るので、同じアーカイブに複数のプロセス
+    # （archive_frames.py と streamlink.py など）が追記しても、シャードの末尾の位置はロック中に
+    # 読み直され、同じ位置に書き込んだり互いの書き込みを切り詰めたりしない
+    @contextmanager
+    def _write_transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.rollback()
+            raise
+        self._conn.commit()
+
+    # 追記中のシャードの末尾にメンバーを書き込む（書き込んでから索引をコミットする）
+    # 索引のコミット前に中断した場合、次の追記で索引の末尾まで切り詰める
+    # _write_transaction の中で呼ぶこと
+    def _append(self, key, data, metadata):
+        metadata_bytes = json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+        needed = 3 * TAR_BLOCK + len(data) + len(metadata_bytes) + 2 * TAR_BLOCK
+        shard = self._writable_shard(needed)
+        row = self._conn.execute(
+            "SELECT size, frames FROM shards WHERE name = ?", (shard,)
+        ).fetchone()
+        start = row["size"]
+
+        f = self._file
+        f.seek(start)
+        f.truncate()
+        header = _member_header(f"{key}.jpg", len(data))
+        offset = start + len(header)
+        f.write(header)
+        f.write(data)
+        f.write(_padding(len(data)))
+        f.write(_member_header(f"{key}.json", len(metadata_bytes)))
+        f.write(metadata_bytes)
+        f.write(_padding(len(metadata_bytes)))
+        f.flush()
+        os.fsync(f.fileno())
+
+        self._conn.execute(
+            "UPDATE shards SET size = ?, frames = ? WHERE name = ?",
+            (f.tell(), row["frames"] + 1, shard),
+        )
+        return shard, offset
+
+    def _writable_shard(self, needed):
+        row = self._conn.execute(
+            "SELECT name, size, frames FROM shards WHERE sealed = 0 "
+            "ORDER BY name DESC LIMIT 1"
+        ).fetchone()
+        if row is not None and row["frames"] and row["size"] + needed > self.shard_size:
+            self._seal(row["name"], row["size"])
+            row = None
+        if row is None:
+            count = self._conn.execute("SELECT COUNT(*) FROM shards").fetchone()[0]
+            name = f"shard-{count:06d}.tar"
+            self._conn.execute(
+                "INSERT INTO shards VALUES (?, 0, 0, 0)",
+                (name,),
+            )
+            row = {"name": name}
+        if self._shard != row["name"]:
+            self._close_file()
+            path = os.path.join(self.shard_dir, row["name"])
+            self._file = open(path, "r+b" if os.path.exists(path) else "w+b")
+            self._shard = row["name"]
+        return row["name"]
+
+    # tar の終端（空のブロック2つ）を書いて、以降は追記しない
+    def _seal(self, name, size):
+        if self._shard != name:
+            self._close_file()
+            self._file = open(os.path.join(self.shard_dir, name), "r+b")
+            self._shard = name
+        self._file.seek(size)
+        self._file.truncate()
+        self._file.write(b"\0" * 2 * TAR_BLOCK)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._conn.execute(
+            "UPDATE shards SET size = ?, sealed = 1 WHERE name = ?",
+            (size + 2 * TAR_BLOCK, name),
+        )
+        self._close_file()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._shard = None
+
+    # 追記中のシャードも終端を書いて閉じる（開き直すと次のシャードから追記する）
+    def seal(self):
+        with self._lock, self._write_transaction():
+            for row in self._conn.execute(
+                "SELECT name, size FROM shards WHERE sealed = 0"
+            ).fetchall():
+                self._seal(row["name"], row["size"])
+
+    def close(self):
+        with self._lock:
+            self._close_file()
+            self._conn.close()
+
+    # 取得時刻の範囲の記録を時刻順に返す（シャード内の位置と切り出し範囲を含む）
+    def captures(self, start=None, end=None, site=None):
+        query = (
+            "SELECT c.site, c.timestamp, c.hash, c.rects, c.source, "
+            "b.shard, b.offset, b.size, b.width, b.height "
+            "FROM captures c JOIN blobs b ON b.hash = c.hash WHERE 1 = 1"
+        )
+        params = []
+        if start is not None:
+            query += " AND c.timestamp >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND c.timestamp < ?"
+            params.append(end)
+        if site is not None:
+            query += " AND c.site = ?"
+            params.append(site)
+        query += " ORDER BY c.timestamp, c.site"
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [_capture(row) for row in rows]
+
+    # 指定した時刻以前で最も新しい記録（なければ None）
+    def find(self, timestamp, site=None):
+        query = (
+            "SELECT c.site, c.timestamp, c.hash, c.rects, c.source, "
+            "b.shard, b.offset, b.size, b.width, b.height "
+            "FROM captures c JOIN blobs b ON b.hash = c.hash WHERE c.timestamp <= ?"
+        )
+        params = [timestamp]
+        if site is not None:
+            query += " AND c.site = ?"
+            params.append(site)
+        query += " ORDER BY c.timestamp DESC LIMIT 1"
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+        return _capture(row) if row is not None else None
+
+    def read(self, capture):
+        return read_frame(self.root, capture)
+
+    # 記録を時刻順に (記録, RGB 配列) で返す
+    # シャードごとにファイルを開いたまま前から順に読むため、個別のファイルを開くより速い
+    def iter_frames(self, start=None, end=None, site=None):
+        shard, f = None, None
+        try:
+            for capture in self.captures(start, end, site):
+                if capture["shard"] != shard:
+                    if f is not None:
+                        f.close()
+                    shard, f = capture["shard"], _open_shard(self.root, capture)
+                f.seek(capture["offset"])
+                yield capture, decode_frame(f.read(capture["size"]))
+        finally:
+            if f is not None:
+                f.close()
+
+    def stats(self):
+        with self._lock:
+            shards, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM shards"
+            ).fetchone()
+            blobs = self._conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+            captures = self._conn.execute("SELECT COUNT(*) FROM captures").fetchone()[0]
+        return {
+            "shards": shards,
+            "bytes": size,
+            "frames": blobs,
+            "captures": captures,
+            "duplicates": captures - blobs,
+        }
+
+
+def _capture(row):
+    capture = dict(row)
+    capture["rects"] = json.loads(capture["rects"]) if capture["rects"] else {}
+    return capture
+
+
+def _member_header(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    return info.tobuf(format=tarfile.USTAR_FORMAT)
+
+
+def _padding(size):
+    return b"\0" * (-size % TAR_BLOCK)
+
+
+def _open_shard(root, capture):
+    return open(os.path.join(root, "shards", capture["shard"]), "rb")
+
+
+# 記録の JPEG のバイト列を読む（索引を使わないので DataLoader のワーカーからも呼べる）
+def read_frame(root, capture):
+    with _open_shard(root, capture) as f:
+        f.seek(capture["offset"])
+        return f.read(capture["size"])
+
+
+def decode_frame(data):
+    with Image.open(io.BytesIO(data)) as image:
+        return np.array(image.convert("RGB"))
+
+
+# 記録の切り出し範囲で、フレームから各駐車場の領域をビューとして切り出す
+def crop_frame(image, capture, names=None):
+    rects = capture["rects"]
+    return [
+        (name, image[y0:y1, x0:x1])
+        for name, (x0, y0, x1, y1) in rects.items()
+        if names is None or name in names
+    ]
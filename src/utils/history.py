@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from utils.status import CROWDED, EMPTY, FULL
+
+GRANULARITIES = {
+    # 集計単位 -> (テーブル名, タイムスタンプの切り詰め桁数, バケットの末尾)
+    "hourly": ("rollup_hourly", 13, ":00:00"),
+    "daily": ("rollup_daily", 10, "T00:00:00"),
+}
+
+
+# 予測結果の時系列を保存するストア（SQLite）
+# 生データは (lot, ts) のインデックス付きで追記し、時間・日単位の集計テーブルも同時に更新する
+class OccupancyStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS observations (
+                lot TEXT NOT NULL,
+                ts TEXT NOT NULL,
+                status TEXT NOT NULL,
+                source TEXT
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS observations_lot_ts ON observations (lot, ts)"
+        )
+        for table, _, _ in GRANULARITIES.values():
+            self._conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    lot TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    samples INTEGER NOT NULL,
+                    n_empty INTEGER NOT NULL,
+                    n_full INTEGER NOT NULL,
+                    n_crowded INTEGER NOT NULL,
+                    PRIMARY KEY (lot, bucket)
+                )
+                """
+            )
+        self._conn.commit()
+
+    # results: {output_name: status}（例: {"takeda_a.jpg": "1"}）
+    def append(self, results, ts=None, source=None):
+        if ts is None:
+            ts = datetime.now().isoformat(timespec="seconds")
+        rows = [
+            (os.path.splitext(output_name)[0], ts, status, source)
+            for output_name, status in results.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO observations (lot, ts, status, source) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            for table, length, suffix in GRANULARITIES.values():
+                self._conn.executemany(
+                    f"""
+                    INSERT INTO {table} VALUES (?, ?, 1, ?, ?, ?)
+                    ON CONFLICT (lot, bucket) DO UPDATE SET
+                        samples = samples + 1,
+                        n_empty = n_empty + excluded.n_empty,
+                        n_full = n_full + excluded.n_full,
+                        n_crowded = n_crowded + excluded.n_crowded
+                    """,
+                    [
+                        (
+                            lot,
+                            row_ts[:length] + suffix,
+                            int(status == EMPTY),
+                            int(status == FULL),
+                            int(status == CROWDED),
+                        )
+                        for lot, row_ts, status, _ in rows
+                    ],
+                )
+
+    def query(self, lot=None, start=None, end=None, granularity="raw", limit=10000):
+        conditions = []
+        params = []
+        time_column = "ts" if granularity == "raw" else "bucket"
+        if lot is not None:
+            conditions.append("lot = ?")
+            params.append(lot)
+        if start is not None:
+            conditions.append(f"{time_column} >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append(f"{time_column} < ?")
+            params.append(end)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(limit)
+
+        with self._lock:
+            if granularity == "raw":
+                rows = self._conn.execute(
+                    f"SELECT lot, ts, status FROM observations {where} "
+                    "ORDER BY lot, ts LIMIT ?",
+                    params,
+                ).fetchall()
+                return [
+                    {"lot": lot, "ts": ts, "status": status}
+                    for lot, ts, status in rows
+                ]
+
+            if granularity not in GRANULARITIES:
+                raise ValueError(f"Unknown granularity: {granularity}")
+            table = GRANULARITIES[granularity][0]
+            rows = self._conn.execute(
+                f"SELECT lot, bucket, samples, n_empty, n_full, n_crowded FROM {table} "
+                f"{where} ORDER BY lot, bucket LIMIT ?",
+                params,
+            ).fetchall()
+        return [
+            {
+                "lot": lot,
+                "bucket": bucket,
+                "samples": samples,
+                "empty": empty,
+                "full": full,
+                "crowded": crowded,
+                "empty_ratio": empty / samples,
+                "full_ratio": full / samples,
+                "crowded_ratio": crowded / samples,
+            }
+            for lot, bucket, samples, empty, full, crowded in rows
+        ]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = OccupancyStore(os.getenv("HISTORY_DB", "data/history.sqlite"))
+        return _store
+
+
+# 予測の流れを止めないよう、保存に失敗してもログを出すだけにする
+def record_results(results, ts=None, source=None):
+    try:
+        get_store().append(results, ts=ts, source=source)
+    except Exception as e:
+        print(f"履歴の保存でエラーが発生しました: {e}")
@@ -1,18 +1,61 @@
 from PIL import Image
+import io
 import os
+import numpy as np
+from utils.layout import decode_file, get_layout
+from utils.metrics import metrics
 
 
-def split_image(filepath, target_folder, models_and_outputs):
-    image = Image.open(filepath)
-    width, height = image.size
-    segment_height = height // len(models_and_outputs)
-    segments = []
+# layout を省略した場合は既定のレイアウト（LAYOUT_FILE）を使う
+def split_image(filepath, target_folder, models_and_outputs, layout=None):
+    with metrics.timer("split"):
+        layout = layout or get_layout()
+        image, _ = decode_file(filepath)
+        segments = []
 
-    for i, (model_path, output_name) in enumerate(models_and_outputs.items()):
-        box = (0, i * segment_height, width, (i + 1) * segment_height)
-        segment = image.crop(box)
-        segment_path = os.path.join(target_folder, output_name)
-        segment.save(segment_path)
-        segments.append((segment_path, model_path, output_name))
+        for view, model_path, output_name in layout.segments(
+            image, models_and_outputs
+        ):
+            segment_path = os.path.join(target_folder, output_name)
+            layout.to_image(view).save(segment_path)
+            segments.append((segment_path, model_path, output_name))
 
-    return segments
+        return segments
+
+
+# 学習用のフレーム（data/train/raw/YYYY/MM/DD/frame_HHMMSS.jpg）を駐車場ごとのフォルダに分割して保存する
+# 保存名は日付を付けたファイル名（例: 2024_11_06_frame_HHMMSS.jpg）
+# min_size を指定すると、各セグメントがその大きさ以上を保てる範囲で縮小してデコードする
+def split_training_frame(filepath, target_folder, models_and_outputs, min_size=0):
+    with metrics.timer("split"):
+        layout = get_layout()
+        image, scale = decode_file(filepath, min_size, len(models_and_outputs))
+        segments = []
+
+        # 日付ディレクトリを "2024_11_06" に変換してファイル名の前に付ける
+        date_str = (
+            os.path.dirname(filepath).replace("data/train/raw/", "").replace("/", "_")
+        )
+        base_filename = f"{date_str}_{os.path.basename(filepath)}"
+
+        for model_name, view in layout.crop(image, models_and_outputs.keys(), scale):
+            model_folder = os.path.join(target_folder, model_name)
+            os.makedirs(model_folder, exist_ok=True)
+
+            segment_path = os.path.join(model_folder, base_filename)
+            layout.to_image(view).save(segment_path)
+            segments.append((segment_path, model_name, base_filename))
+
+        return segments
+
+
+# アップロードされたバイト列を1回だけデコードして RGB 配列にする
+def decode_image(data):
+    with metrics.timer("decode"), Image.open(io.BytesIO(data)) as image:
+        return np.array(image.convert("RGB"))
+
+
+# メモリ上で分割（各セグメントは元配列のビューでコピーもエンコードも行わない）
+def split_image_array(image, models_and_outputs, layout=None):
+    with metrics.timer("split"):
+        return (layout or get_layout()).segments(image, models_and_outputs)
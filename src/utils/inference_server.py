@@ -0,0 +1,155 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+from utils.cpu_tuning import tuning
+from utils.metrics import lot_name, metrics
+from utils.model_registry import registry
+from utils.multihead import LotHead
+from utils.predict import preprocess_image, to_status
+
+
+# 同時に届いたリクエストの分割画像を短い時間窓でまとめ、モデルごとに1バッチで推論するワーカー
+# 各リクエストには Future で自分の結果（{output_name: status}）を返す
+class InferenceServer:
+    def __init__(self, model_registry, batch_window=0.01, max_batch_size=64):
+        self.registry = model_registry
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="inference-server", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, segments):
+        # 前処理は呼び出し側のスレッドで行い、ワーカーは推論だけを担当する
+        with metrics.timer("preprocess"):
+            crops = [
+                (preprocess_image(segment, "cpu"), model_path, output_name)
+                for segment, model_path, output_name in segments
+            ]
+        future = Future()
+        self._queue.put((crops, future))
+        return future
+
+    def _collect(self):
+        request = self._queue.get()
+        if request is None:
+            return []
+        batch = [request]
+        size = len(request[0])
+        deadline = time.monotonic() + self.batch_window
+
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._stopped.set()
+                break
+            batch.append(request)
+            size += len(request[0])
+
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+            pending = [
+                (crops, future)
+                for crops, future in batch
+                if future.set_running_or_notify_cancel()
+            ]
+            try:
+                results = self._infer([crops for crops, _ in pending])
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(pending, results):
+                future.set_result(result)
+
+        # 停止後に残ったリクエストはエラーで返す
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request[1].set_exception(RuntimeError("Inference server stopped"))
+
+    def _infer(self, requests):
+        results = [{} for _ in requests]
+
+        # モデルごとに全リクエストの分割画像をまとめる
+        groups = {}
+        for request_index, crops in enumerate(requests):
+            for tensor, model_path, output_name in crops:
+                groups.setdefault(model_path, []).append(
+                    (request_index, output_name, tensor)
+                )
+
+        # バックボーンを共有する駐車場（LotHead）は、共有モデルごとに1バッチにまとめる
+        passes = {}
+        for model_path, items in groups.items():
+            model, device = self.registry.get(model_path)
+            lot = lot_name(model_path)
+            metrics.inc("inference_images_total", len(items), lot=lot)
+            if isinstance(model, LotHead):
+                key = id(model.shared)
+                if key not in passes:
+                    passes[key] = (model.shared, device, "shared", [], [])
+                passes[key][3].extend(items)
+                passes[key][4].extend([model.lot] * len(items))
+            else:
+                passes[model_path] = (model, device, lot, items, None)
+
+        for model, device, lot, items, lots in passes.values():
+            images = torch.cat([tensor for _, _, tensor in items]).to(device)
+            with metrics.timer("inference", lot=lot), tuning.inference_context(
+                device
+            ):
+                if lots is None:
+                    outputs = model(images)
+                else:
+                    outputs = model(images, model.indices(lots, device))
+                _, preds = torch.max(outputs, 1)
+            for (request_index, output_name, _), pred in zip(items, preds.tolist()):
+                results[request_index][output_name] = to_status(pred)
+
+        return results
+
+
+inference_server = InferenceServer(
+    registry,
+    batch_window=float(os.getenv("INFERENCE_BATCH_WINDOW_MS", "10")) / 1000,
+    max_batch_size=int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "64")),
+)
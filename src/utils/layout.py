@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_LAYOUT_FILE = "config/layout.json"
+
+
+# 1フレームから各駐車場の領域を切り出すレイアウト
+# 領域は設定ファイルで駐車場ごとに指定する
+#   "band": [i, n]         高さを n 等分した i 番目の帯（height // n 単位、従来の分割と同じ）
+#   "rect": [x0, y0, x1, y1]  units が "fraction" なら画像サイズに対する割合、"pixel" なら画素
+# resize を指定すると、保存用の切り出し画像をそのサイズ（幅, 高さ）に縮小する
+class Layout:
+    def __init__(self, lots, units="fraction", resize=None):
+        self.lots = {lot["name"]: lot for lot in lots}
+        self.units = units
+        self.resize = tuple(resize) if resize else None
+        self._boxes = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        return cls(
+            config["lots"],
+            units=config.get("units", "fraction"),
+            resize=config.get("resize"),
+        )
+
+    # 画像サイズごとに各駐車場の切り出し範囲（x0, y0, x1, y1）を計算してキャッシュする
+    def box(self, name, width, height, scale=1.0):
+        key = (name, width, height, scale)
+        box = self._boxes.get(key)
+        if box is not None:
+            return box
+
+        if name not in self.lots:
+            raise KeyError(f"Lot {name} is not defined in the layout")
+        lot = self.lots[name]
+        if "band" in lot:
+            i, n = lot["band"]
+            segment_height = height // n
+            box = (0, i * segment_height, width, (i + 1) * segment_height)
+        elif self.units == "pixel":
+            x0, y0, x1, y1 = (int(round(v * scale)) for v in lot["rect"])
+            box = (x0, y0, min(x1, width), min(y1, height))
+        else:
+            x0, y0, x1, y1 = lot["rect"]
+            box = (
+                int(round(x0 * width)),
+                int(round(y0 * height)),
+                int(round(x1 * width)),
+                int(round(y1 * height)),
+            )
+        self._boxes[key] = box
+        return box
+
+    # 各駐車場の切り出し範囲（画素）を {名前: [x0, y0, x1, y1]} で返す（アーカイブのメタデータ用）
+    def rects(self, names, width, height):
+        return {name: list(self.box(name, width, height)) for name in names}
+
+    # 各駐車場の領域を元の配列のビューとして返す（コピーもエンコードもしない）
+    def crop(self, image, names, scale=1.0):
+        height, width = image.shape[:2]
+        crops = []
+        for name in names:
+            x0, y0, x1, y1 = self.box(name, width, height, scale)
+            crops.append((name, image[y0:y1, x0:x1]))
+        return crops
+
+    # run_predictions に渡す (セグメント, モデルのパス, 出力名) のリストを作る
+    def segments(self, image, models_and_outputs):
+        names = [
+            os.path.splitext(output_name)[0]
+            for output_name in models_and_outputs.values()
+        ]
+        return [
+            (view, model_path, output_name)
+            for (_, view), (model_path, output_name) in zip(
+                self.crop(image, names), models_and_outputs.items()
+            )
+        ]
+
+    # 保存用の切り出し画像（resize 指定があれば縮小する）
+    def to_image(self, view):
+        image = Image.fromarray(view)
+        if self.resize is not None:
+            image = image.resize(self.resize, Image.BILINEAR)
+        return image
+
+
+# 従来と同じ、高さを等分した帯のレイアウト
+def band_layout(names):
+    return Layout(
+        [{"name": name, "band": [i, len(names)]} for i, name in enumerate(names)]
+    )
+
+
+_layout = None
+_layout_lock = threading.Lock()
+
+
+# 設定ファイル（環境変数 LAYOUT_FILE、既定は config/layout.json）からレイアウトを読み込む
+def get_layout():
+    global _layout
+    with _layout_lock:
+        if _layout is None:
+            _layout = Layout.load(os.getenv("LAYOUT_FILE", DEFAULT_LAYOUT_FILE))
+        return _layout
+
+
+# 画像ファイルを1回だけデコードして RGB 配列にする
+def decode_file(filepath, min_size=0, segments=1):
+    with Image.open(filepath) as image:
+        original_width = image.size[0]
+        # JPEG は縮小デコードできるので、各セグメントが min_size 以上を保てる範囲で縮小して読む
+        if min_size:
+            image.draft("RGB", (min_size, min_size * segments))
+        scale = image.size[0] / original_width
+        return np.array(image.convert("RGB")), scale
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# 処理時間のヒストグラムの境界（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+# モデルのパスや出力名から駐車場名を取り出す
+# 例: models/parking_model_takeda_a.pth -> takeda_a, takeda_a.jpg -> takeda_a
+#     models/parking_model_shared.safetensors#takeda_a -> takeda_a
+def lot_name(path):
+    if "#" in path:
+        return path.rsplit("#", 1)[1]
+    name = os.path.basename(path).split(".", 1)[0]
+    return name.replace("parking_model_", "", 1)
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+# 段階（stage）・駐車場（lot）ごとの処理時間と件数を集計し、Prometheus のテキスト形式で出力する
+# 値はプロセス内のメモリにだけ持つ（Flask は /metrics、バッチはファイルに書き出す）
+class Metrics:
+    def __init__(self, prefix="parking", buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # (名前, ラベル) -> _Histogram / 値
+        self._histograms = {}
+        self._counters = {}
+        self._dump_thread = None
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def observe(self, name, seconds, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    # with metrics.timer("split", lot="takeda_a"): ... で処理時間を記録する
+    # 例外で抜けた場合は処理時間に加えてエラー件数も数える
+    @contextmanager
+    def timer(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc("stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe(
+                "stage_seconds", time.perf_counter() - start, stage=stage, **labels
+            )
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (
+            (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self):
+        with self._lock:
+            histograms = {
+                key: (list(h.counts), h.count, h.sum)
+                for key, h in self._histograms.items()
+            }
+            counters = dict(self._counters)
+
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for (key_name, labels), (counts, count, total) in sorted(
+                histograms.items()
+            ):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        f"{metric}_bucket"
+                        f"{self._format_labels(labels, [('le', repr(float(bound)))])}"
+                        f" {cumulative}"
+                    )
+                lines.append(
+                    f"{metric}_bucket{self._format_labels(labels, [('le', '+Inf')])}"
+                    f" {count}"
+                )
+                lines.append(f"{metric}_sum{self._format_labels(labels)} {total}")
+                lines.append(f"{metric}_count{self._format_labels(labels)} {count}")
+
+        for name in sorted({name for name, _ in counters}):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} counter")
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append(f"{metric}{self._format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    # node_exporter の textfile コレクター等で読めるよう、一時ファイル経由で置き換える
+    def dump(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    # interval 秒ごとにファイルへ書き出すスレッドを起動する（stop_event で終了し、最後に1回書き出す）
+    def start_dump(self, path, interval, stop_event):
+        def run():
+            while not stop_event.wait(interval):
+                try:
+                    self.dump(path)
+                except OSError as e:
+                    print(f"メトリクスの書き出しに失敗しました: {e}")
+            self.dump(path)
+
+        self._dump_thread = threading.Thread(
+            target=run, name="metrics-dump", daemon=True
+        )
+        self._dump_thread.start()
+        return self._dump_thread
+
+
+metrics = Metrics()
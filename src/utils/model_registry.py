@@ -0,0 +1,151 @@
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from utils.backends import artifact_path
+from utils.cpu_tuning import tuning
+from utils.predict import ModelEnsemble, load_model
+
+
+# プロセス全体で共有するモデルのレジストリ
+# 起動時に全モデルをロード・ウォームアップし、.pthファイルが更新されたら再ロードする
+class ModelRegistry:
+    def __init__(self, warmup=True, backend=None, max_ensembles=8):
+        self.warmup = warmup
+        self.max_ensembles = max_ensembles
+        self._backend = backend
+        self._lock = threading.RLock()
+        # model_path -> {"model", "device", "mtime", "load_seconds", "warmup_seconds"}
+        self._entries = {}
+        # 重複を除いて並べた model_paths -> (ロード時のモデルid, ModelEnsemble)
+        # 最近使った max_ensembles 個だけを残す（積み重ねたパラメータのコピーを持つため）
+        self._ensembles = OrderedDict()
+        # モデルを再ロードしたときに呼び出す関数（キャッシュの破棄など）
+        self._reload_listeners = []
+
+    # 推論バックエンド（未指定の場合は環境変数 INFERENCE_BACKEND、既定は eager）
+    @property
+    def backend(self):
+        return self._backend or os.getenv("INFERENCE_BACKEND", "eager")
+
+    def preload(self, model_paths):
+        for model_path in model_paths:
+            self._load(model_path)
+        return self.timings()
+
+    def get(self, model_path):
+        with self._lock:
+            entry = self._entries.get(model_path)
+            if entry is None or self._is_stale(model_path, entry):
+                entry = self._load(model_path)
+            return entry["model"], entry["device"]
+
+    # 各モデルのバージョン（ロードしたファイルの更新時刻とバックエンド）
+    def versions(self, model_paths):
+        with self._lock:
+            versions = []
+            for model_path in model_paths:
+                self.get(model_path)
+                entry = self._entries[model_path]
+                versions.append((model_path, f"{entry['backend']}:{entry['mtime']}"))
+            return versions
+
+    def add_reload_listener(self, listener):
+        self._reload_listeners.append(listener)
+
+    # i 番目の画像を model_paths[i] のモデルで推論する関数と、デバイスを返す
+    # アンサンブルは重複を除いたモデルの組み合わせごとに1つ作り、各画像はその中のモデルの番号で推論する
+    # model_set にサイトの全モデルを渡すと、一部の区画だけを推論する場合も同じアンサンブルを使い回す
+    def get_ensemble(self, model_paths, model_set=()):
+        model_paths = list(model_paths)
+        key = tuple(sorted(set(model_paths) | set(model_set)))
+        with self._lock:
+            loaded = {model_path: self.get(model_path) for model_path in key}
+            models = [loaded[model_path][0] for model_path in key]
+            model_ids = tuple(id(model) for model in models)
+            cached = self._ensembles.get(key)
+            if cached is None or cached[0] != model_ids:
+                cached = (model_ids, ModelEnsemble(models))
+                self._ensembles[key] = cached
+            self._ensembles.move_to_end(key)
+            while len(self._ensembles) > self.max_ensembles:
+                self._ensembles.popitem(last=False)
+        position = {model_path: i for i, model_path in enumerate(key)}
+        model_indices = [position[model_path] for model_path in model_paths]
+        ensemble = functools.partial(cached[1], model_indices=model_indices)
+        return ensemble, loaded[model_paths[0]][1]
+
+    def reload_changed(self):
+        reloaded = []
+        with self._lock:
+            for model_path, entry in list(self._entries.items()):
+                if self._is_stale(model_path, entry):
+                    self._load(model_path)
+                    reloaded.append(model_path)
+        return reloaded
+
+    def timings(self):
+        with self._lock:
+            return {
+                model_path: {
+                    "load_seconds": entry["load_seconds"],
+                    "warmup_seconds": entry["warmup_seconds"],
+                    "loaded_at": entry["loaded_at"],
+                    "backend": entry["backend"],
+                }
+                for model_path, entry in self._entries.items()
+            }
+
+    def _is_stale(self, model_path, entry):
+        try:
+            path = artifact_path(model_path, entry["backend"])
+            return os.path.getmtime(path) != entry["mtime"]
+        except OSError:
+            # ファイルが一時的に存在しない場合（書き込み中など）は既存のモデルを使い続ける
+            return False
+
+    def _load(self, model_path):
+        with self._lock:
+            backend = self.backend
+            mtime = os.path.getmtime(artifact_path(model_path, backend))
+            start = time.perf_counter()
+            model, device = load_model(model_path, backend)
+            load_seconds = time.perf_counter() - start
+            # CPU_TUNING=auto なら、このホストで初めてのロード時に推論設定を計測する
+            if tuning.ensure_tuned(model, device):
+                model = tuning.prepare_model(model, device)
+
+            warmup_seconds = 0.0
+            if self.warmup:
+                start = time.perf_counter()
+                with tuning.inference_context(device):
+                    model(
+                        tuning.prepare_input(torch.zeros(1, 3, 224, 224, device=device))
+                    )
+                warmup_seconds = time.perf_counter() - start
+
+            reloaded = model_path in self._entries
+            entry = {
+                "model": model,
+                "device": device,
+                "mtime": mtime,
+                "load_seconds": load_seconds,
+                "warmup_seconds": warmup_seconds,
+                "loaded_at": time.time(),
+                "backend": backend,
+            }
+            self._entries[model_path] = entry
+            if reloaded:
+                for listener in self._reload_listeners:
+                    listener(model_path)
+            print(
+                f"モデルをロードしました: {model_path} [{backend}] "
+                f"(load {load_seconds:.3f}s, warmup {warmup_seconds:.3f}s)"
+            )
+            return entry
+
+
+registry = ModelRegistry()
@@ -0,0 +1,120 @@
+import json
+import math
+import os
+import threading
+
+import torch
+from torchvision import models
+from utils.checkpoint import load_checkpoint
+from utils.status import CLASS_NAMES
+
+ARCHITECTURE = "resnet18_multihead"
+
+# サイトの設定でモデルを "models/parking_model_shared.safetensors#takeda_a" のように指定すると、
+# 全駐車場で共有するバックボーンと、その駐車場の分類ヘッドを使う
+LOT_SEPARATOR = "#"
+
+
+# ResNet18 のバックボーンを全駐車場で共有し、駐車場ごとに小さな分類ヘッド（512 -> 3 の線形層）を持つモデル
+# 異なる駐車場の切り出し画像を1バッチにまとめ、バックボーンを1回だけ通す
+class MultiHeadResNet(torch.nn.Module):
+    def __init__(self, lots, num_classes=len(CLASS_NAMES)):
+        super().__init__()
+        self.lots = list(lots)
+        self.lot_index = {lot: i for i, lot in enumerate(self.lots)}
+        self.backbone = models.resnet18(weights=None)
+        num_features = self.backbone.fc.in_features
+        self.backbone.fc = torch.nn.Identity()
+        # 駐車場ごとの線形層の重みを (駐車場数, クラス数, 特徴数) にまとめて持つ
+        self.head_weight = torch.nn.Parameter(
+            torch.empty(len(self.lots), num_classes, num_features)
+        )
+        self.head_bias = torch.nn.Parameter(torch.empty(len(self.lots), num_classes))
+        # nn.Linear と同じ初期化
+        bound = 1 / math.sqrt(num_features)
+        torch.nn.init.uniform_(self.head_weight, -bound, bound)
+        torch.nn.init.uniform_(self.head_bias, -bound, bound)
+
+    # images[i] を lot_indices[i] 番目の駐車場のヘッドで分類する
+    def forward(self, images, lot_indices):
+        features = self.backbone(images)
+        weight = self.head_weight[lot_indices]
+        bias = self.head_bias[lot_indices]
+        return torch.einsum("nf,ncf->nc", features, weight) + bias
+
+    def indices(self, lots, device=None):
+        return torch.tensor(
+            [self.lot_index[lot] for lot in lots],
+            dtype=torch.long,
+            device=device if device is not None else self.head_bias.device,
+        )
+
+    def metadata(self):
+        return {
+            "architecture": ARCHITECTURE,
+            "lots": json.dumps(self.lots),
+            "num_classes": self.head_bias.shape[1],
+            "classes": json.dumps(CLASS_NAMES),
+        }
+
+
+# 共有モデルのうち1つの駐車場だけを使うモデル
+# 駐車場ごとのモデルと同じく model(images) で呼び出せるので、レジストリや推論サーバーでそのまま使える
+class LotHead(torch.nn.Module):
+    def __init__(self, shared, lot):
+        super().__init__()
+        self.shared = shared
+        self.lot = lot
+
+    def forward(self, images):
+        lot_indices = self.shared.indices([self.lot] * images.size(0), images.device)
+        return self.shared(images, lot_indices)
+
+
+def is_shared_model_path(model_path):
+    return LOT_SEPARATOR in model_path
+
+
+# "models/parking_model_shared.safetensors#takeda_a" -> ("models/...safetensors", "takeda_a")
+def split_model_path(model_path):
+    path, _, lot = model_path.partition(LOT_SEPARATOR)
+    return path, lot
+
+
+def load_multihead(path):
+    state_dict, metadata = load_checkpoint(path)
+    if metadata.get("architecture") != ARCHITECTURE:
+        raise ValueError(f"{path} is not a {ARCHITECTURE} checkpoint")
+    if json.loads(metadata.get("classes", "null")) not in (None, CLASS_NAMES):
+        raise ValueError(f"Class mapping in {path} does not match {CLASS_NAMES}")
+    lots = json.loads(metadata["lots"])
+    num_classes = int(metadata.get("num_classes", len(CLASS_NAMES)))
+
+    try:
+        with torch.device("meta"):
+            model = MultiHeadResNet(lots, num_classes)
+        model.load_state_dict(state_dict, assign=True)
+    except (AttributeError, TypeError):
+        model = MultiHeadResNet(lots, num_classes)
+        model.load_state_dict(state_dict)
+    return model
+
+
+# 共有モデルはファイルごとに1つだけロードし、全駐車場の LotHead で使い回す
+_shared_models = {}
+_shared_models_lock = threading.Lock()
+
+
+def load_lot_head(model_path, device):
+    path, lot = split_model_path(model_path)
+    mtime = os.path.getmtime(path)
+    with _shared_models_lock:
+        cached = _shared_models.get((path, device))
+        if cached is None or cached[0] != mtime:
+            shared = load_multihead(path).to(device)
+            shared.eval()
+            cached = _shared_models[(path, device)] = (mtime, shared)
+    shared = cached[1]
+    if lot not in shared.lot_index:
+        raise KeyError(f"Lot {lot} is not in {path} ({shared.lots})")
+    return LotHead(shared, lot)
@@ -1,53 +1,285 @@
+import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 from PIL import Image
 from torchvision import models
-from torchvision.models import ResNet18_Weights
+import json
 import os
 import sys
+from datetime import datetime
+from utils.backends import CHECKPOINT_SUFFIX, artifact_path
+from utils.checkpoint import load_checkpoint
+from utils.cpu_tuning import tuning
+from utils.metrics import lot_name, metrics
+from utils.multihead import LotHead, is_shared_model_path, load_lot_head
+from utils.status import CLASS_NAMES, CROWDED, EMPTY, FULL, to_status
 
-EMPTY = "1"
-FULL = "6"
-CROWDED = "5"
+# 重みファイルの形式のバージョン（メタデータの format_version）
+CHECKPOINT_FORMAT_VERSION = "1"
 
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+IMAGE_SIZE = (224, 224)
 
-def load_model(model_path):
+# 前処理（画像ごとに作り直さないようモジュールで1回だけ作る）
+FILE_TRANSFORM = transforms.Compose(
+    [
+        transforms.Resize(IMAGE_SIZE),
+        transforms.ToTensor(),
+        transforms.Normalize(MEAN, STD),
+    ]
+)
+ARRAY_TRANSFORM = transforms.Compose(
+    [
+        transforms.Resize(IMAGE_SIZE, antialias=True),
+        transforms.Normalize(MEAN, STD),
+    ]
+)
+
+# uint8 の画素値 x から (x / 255 - mean) / std を1回の演算（shift + x * scale）で求める
+FUSED_SCALE = torch.tensor([1 / (255 * s) for s in STD]).view(1, 3, 1, 1)
+FUSED_SHIFT = torch.tensor([-m / s for m, s in zip(MEAN, STD)]).view(1, 3, 1, 1)
+
+
+def load_model(model_path, backend="eager"):
+    with metrics.timer("load_model", lot=lot_name(model_path), backend=backend):
+        return _load_model(model_path, backend)
+
+
+def _load_model(model_path, backend):
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    model = models.resnet18(weights=ResNet18_Weights.IMAGENET1K_V1)
-    num_ftrs = model.fc.in_features
-    model.fc = torch.nn.Linear(num_ftrs, 3)
-    model.load_state_dict(torch.load(model_path, map_location=device))
+    # このホスト用に保存された CPU の推論設定（スレッド数など）を適用する
+    tuning.configure()
+    if is_shared_model_path(model_path):
+        # 全駐車場でバックボーンを共有するモデル（batch/train_multihead.py で作成）
+        model = load_lot_head(model_path, device)
+        return tuning.prepare_model(model, device), device
+    if backend != "eager":
+        # 書き出し済みの TorchScript / ONNX / int8 モデルを使う（batch/export.py で作成）
+        from utils.backends import load_backend
+
+        return load_backend(model_path, backend, device)
+
+    path = artifact_path(model_path, backend)
+    if path.endswith(CHECKPOINT_SUFFIX):
+        model = load_checkpoint_model(path)
+    else:
+        # 重みは全て load_state_dict で上書きするため、ImageNet の学習済み重みは取得しない
+        model = models.resnet18(weights=None, num_classes=len(CLASS_NAMES))
+        model.load_state_dict(torch.load(path, map_location=device))
     model = model.to(device)
     model.eval()
-    return model, device
-
-
-# 画像の前処理
-def preprocess_image(image_path, device):
-    preprocess = transforms.Compose(
-        [
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-        ]
-    )
+    return tuning.prepare_model(model, device), device
+
+
+# 重みファイルに書き込むメタデータ（アーキテクチャ、クラスの対応、形式のバージョン）
+def checkpoint_metadata(**extra):
+    metadata = {
+        "format_version": CHECKPOINT_FORMAT_VERSION,
+        "architecture": "resnet18",
+        "num_classes": len(CLASS_NAMES),
+        "classes": json.dumps(CLASS_NAMES),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    metadata.update(extra)
+    return metadata
+
+
+# メモリマップした重みからモデルを作る
+# 重みの領域を確保せずに（meta デバイス上で）モデルを組み立て、ファイル上のテンソルをそのまま割り当てる
+def load_checkpoint_model(path):
+    state_dict, metadata = load_checkpoint(path)
+    architecture = metadata.get("architecture", "resnet18")
+    if architecture != "resnet18":
+        raise ValueError(f"Unsupported architecture in {path}: {architecture}")
+    if metadata.get("classes") and json.loads(metadata["classes"]) != CLASS_NAMES:
+        raise ValueError(f"Class mapping in {path} does not match {CLASS_NAMES}")
+    num_classes = int(metadata.get("num_classes", len(CLASS_NAMES)))
+
+    try:
+        with torch.device("meta"):
+            model = models.resnet18(weights=None, num_classes=num_classes)
+        model.load_state_dict(state_dict, assign=True)
+        # 重みがファイルのページのままであること（ModelEnsemble は積み重ねてコピーしない）
+        model.memory_mapped = True
+    except (AttributeError, TypeError):
+        # meta デバイスや assign に対応していない古い PyTorch では通常どおりコピーする
+        model = models.resnet18(weights=None, num_classes=num_classes)
+        model.load_state_dict(state_dict)
+    return model
+
+
+# 画像の前処理（ファイルパスまたは HxWx3 の uint8 配列を受け付ける）
+# settings の fused_preprocess が有効なら uint8 のまま読み込み、正規化を1回の演算で行う
+def preprocess_image(image_path, device, settings=None):
+    settings = settings or tuning.settings
+    if isinstance(image_path, np.ndarray):
+        return preprocess_array(image_path, device, settings)
+
     image = Image.open(image_path).convert("RGB")
-    image = preprocess(image).unsqueeze(0)
-    return image.to(device)
+    if settings["fused_preprocess"]:
+        # transforms.Resize と同じ PIL のバイリニア補間で縮小してから正規化する
+        image = image.resize(IMAGE_SIZE[::-1], Image.BILINEAR)
+        image = torch.from_numpy(np.asarray(image)).permute(2, 0, 1).unsqueeze(0)
+        image = torch.addcmul(FUSED_SHIFT, image.float(), FUSED_SCALE)
+    else:
+        image = FILE_TRANSFORM(image).unsqueeze(0)
+    return tuning.prepare_input(image.to(device), settings)
+
+
+# メモリ上の画像配列（分割済みのビュー）をディスクを介さずにテンソル化する
+def preprocess_array(array, device, settings=None):
+    settings = settings or tuning.settings
+    image = torch.from_numpy(np.ascontiguousarray(array)).permute(2, 0, 1)
+    if settings["fused_preprocess"]:
+        # 縮小は線形なので、0-255 のまま縮小してから正規化しても結果は同じ
+        image = image.unsqueeze(0).float()
+        if tuple(image.shape[-2:]) != IMAGE_SIZE:
+            image = F.interpolate(
+                image, IMAGE_SIZE, mode="bilinear", align_corners=False, antialias=True
+            )
+        image = torch.addcmul(FUSED_SHIFT, image, FUSED_SCALE)
+    else:
+        image = image.float().div_(255)
+        image = ARRAY_TRANSFORM(image).unsqueeze(0)
+    return tuning.prepare_input(image.to(device), settings)
 
 
 # 画像の予測
-def predict(image_path, model, device):
-    image = preprocess_image(image_path, device)
+# lot: メトリクスのラベルにする駐車場名（画像のファイル名は種類が際限なく増えるので使わない）
+def predict(image_path, model, device, lot=None):
+    with metrics.timer("predict", lot=lot):
+        image = preprocess_image(image_path, device)
+        with tuning.inference_context(device):
+            outputs = model(image)
+            _, preds = torch.max(outputs, 1)
+            return to_status(preds.item())
+
+
+# 複数モデルをまとめて評価する
+# images[i] を models[model_indices[i]] で推論する（model_indices を省略した場合は models[i]）
+# 全モデルに1枚ずつ画像がある場合はパラメータを積み重ねて1回の順伝播で評価し、
+# それ以外（一部のモデルだけ、同じモデルに複数枚、共有バックボーンの駐車場を含む）は
+# モデルごとに画像をまとめて推論する
+# 積み重ねたパラメータは全モデルの重みのコピーになるため、メモリマップした重みのモデルでは積み重ねない
+class ModelEnsemble:
+    def __init__(self, models):
+        self.models = list(models)
+        try:
+            self._forward = stacked_forward(self.models)
+        except RuntimeError as e:
+            print(f"パラメータを積み重ねられないためモデルごとに推論します: {e}")
+            self._forward = None
+
+    def __call__(self, images, model_indices=None):
+        if model_indices is None:
+            model_indices = list(range(len(self.models)))
+        if self._forward is not None and sorted(model_indices) == list(
+            range(len(self.models))
+        ):
+            try:
+                if model_indices == sorted(model_indices):
+                    return self._forward(images)
+                # モデルの順に並べ替えて一括推論し、元の順に戻す
+                order = torch.tensor(
+                    sorted(range(len(model_indices)), key=model_indices.__getitem__),
+                    device=images.device,
+                )
+                outputs = self._forward(images[order])
+                return outputs.new_empty(outputs.shape).index_copy_(0, order, outputs)
+            except RuntimeError as e:
+                print(f"一括推論に失敗したためモデルごとに推論します: {e}")
+                self._forward = None
+        return self._forward_by_model(images, model_indices)
+
+    # モデルごとに担当する画像をまとめ、1モデル1回ずつ推論する
+    # 共有バックボーンの駐車場（LotHead）は共有モデルごとにまとめ、バックボーンを1回だけ通す
+    def _forward_by_model(self, images, model_indices):
+        # キー -> (モデル, 画像の位置, 駐車場名（LotHead の場合）)
+        groups = {}
+        for i, index in enumerate(model_indices):
+            model = self.models[index]
+            if isinstance(model, LotHead):
+                group = groups.setdefault(
+                    ("shared", id(model.shared)), (model.shared, [], [])
+                )
+                group[2].append(model.lot)
+            else:
+                group = groups.setdefault(("model", index), (model, [], None))
+            group[1].append(i)
+        outputs = None
+        for model, positions, lots in groups.values():
+            rows = torch.tensor(positions, device=images.device)
+            if lots is None:
+                output = model(images[rows])
+            else:
+                output = model(images[rows], model.indices(lots, images.device))
+            if outputs is None:
+                outputs = output.new_empty((images.size(0), *output.shape[1:]))
+            outputs[rows] = output
+        return outputs
+
+
+# 複数の ResNet18 のパラメータを積み重ね、images[i] を model_list[i] で1回の順伝播で評価する関数
+# 積み重ねられない場合（ResNet18 以外、メモリマップした重み、torch.func がない）は None
+def stacked_forward(model_list):
+    if not all(isinstance(model, models.ResNet) for model in model_list):
+        return None
+    if any(getattr(model, "memory_mapped", False) for model in model_list):
+        return None
+    try:
+        from torch.func import functional_call, stack_module_state
+    except ImportError:
+        return None
+
+    params, buffers = stack_module_state(model_list)
+    # 形だけのモデル（重みの領域を確保しない）に、積み重ねたパラメータを渡して呼び出す
+    # BatchNorm が学習時の統計を使わないよう、推論モードにする
+    with torch.device("meta"):
+        base = models.resnet18(weights=None, num_classes=model_list[0].fc.out_features)
+    base.eval()
+
+    def forward_one(p, b, x):
+        return functional_call(base, (p, b), (x.unsqueeze(0),)).squeeze(0)
+
+    vmapped = torch.vmap(forward_one)
+
+    def forward(images):
+        return vmapped(params, buffers, images)
+
+    # 一括推論の結果が、各モデルを推論モードで個別に推論した結果と一致しなければ使わない
+    device = next(model_list[0].parameters()).device
+    sample = torch.randn(len(model_list), 3, 64, 64, device=device)
     with torch.no_grad():
-        outputs = model(image)
+        expected = torch.cat(
+            [model.eval()(sample[i : i + 1]) for i, model in enumerate(model_list)]
+        )
+        if not torch.allclose(forward(sample), expected, rtol=1e-3, atol=1e-4):
+            print("一括推論の結果がモデルごとの推論と一致しないため使いません")
+            return None
+    return forward
+
+
+# 複数画像をまとめて前処理し、1つのテンソルにする
+def preprocess_batch(image_paths, device, settings=None):
+    with metrics.timer("preprocess"):
+        return torch.cat(
+            [preprocess_image(image, device, settings) for image in image_paths]
+        )
+
+
+# 前処理済みテンソルの一括予測（images[i] を ensemble の i 番目のモデルで分類）
+def predict_tensors(images, ensemble):
+    with metrics.timer("inference"), tuning.inference_context(images.device):
+        outputs = ensemble(images)
         _, preds = torch.max(outputs, 1)
-        if preds.item() == 0:
-            return CROWDED
-        elif preds.item() == 1:
-            return EMPTY
-        else:
-            return FULL
+    return [to_status(pred) for pred in preds.tolist()]
+
+
+# 複数画像の一括予測
+def predict_batch(image_paths, ensemble, device):
+    return predict_tensors(preprocess_batch(image_paths, device), ensemble)
 
 
 # メイン処理
@@ -68,5 +300,5 @@ if __name__ == "__main__":
         sys.exit(1)
 
     model, device = load_model(model_path)
-    result = predict(image_path, model, device)
+    result = predict(image_path, model, device, lot=lot_name(model_path))
     print(result)
@@ -0,0 +1,65 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from utils.model_registry import registry
+
+
+# アップロードされた画像のハッシュとモデルのバージョンをキーにした予測結果のキャッシュ
+# 件数上限（LRU）と有効期限があり、モデルが再ロードされたら全て破棄する
+class ResultCache:
+    def __init__(self, model_registry, max_entries=256, ttl=300):
+        self.registry = model_registry
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (保存した時刻, 結果)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        model_registry.add_reload_listener(self._on_reload)
+
+    # 画像のハッシュ、サイト名、各モデルのバージョンと出力名からキーを作る
+    # （同じモデルのファイルを使うサイトでも、レイアウトや出力名が違うので結果を共有しない）
+    def key(self, data, models_and_outputs, site=""):
+        digest = hashlib.sha256(data)
+        digest.update(f"\0{site}".encode())
+        for model_path, version in self.registry.versions(models_and_outputs.keys()):
+            output_name = models_and_outputs[model_path]
+            digest.update(f"\0{model_path}\0{version}\0{output_name}".encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, results):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _on_reload(self, model_path):
+        self.clear()
+
+
+result_cache = ResultCache(
+    registry,
+    max_entries=int(os.getenv("RESULT_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("RESULT_CACHE_TTL", "300")),
+)
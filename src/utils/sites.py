@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+
+from utils.layout import Layout, get_layout
+
+DEFAULT_SITES_FILE = "config/sites.json"
+
+
+# 監視する駐車場（サイト）ごとの設定
+# 1つのカメラ映像（ストリーム）に対して、分割レイアウト・各区画のモデル・Visitory の ID を持つ
+#   "url" / "url_env"   ストリームの URL（url_env は URL を入れた環境変数名）
+#   "layout"            分割レイアウトの設定ファイル（省略時は LAYOUT_FILE）
+#   "interval"          取得間隔（秒）
+#   "schedule"          変化に合わせて取得間隔を変える設定（utils/capture_schedule.py）
+#   "lots"              区画ごとの {"name", "model", "visitory_id" / "visitory_id_env"}
+# 区画名は履歴や変化検出のキーになるため、全サイトを通して重複させない
+class Site:
+    def __init__(self, config):
+        self.name = config["name"]
+        self.config = config
+        self.backend = config.get("backend", "yt-dlp")
+        self.interval = config.get("interval", 600)
+        self.lots = config["lots"]
+        self._layout = None
+
+    @property
+    def url(self):
+        if "url_env" in self.config:
+            return os.getenv(self.config["url_env"])
+        return self.config.get("url")
+
+    @property
+    def schedule(self):
+        return self.config.get("schedule", {})
+
+    @property
+    def layout(self):
+        if self._layout is None:
+            layout_file = self.config.get("layout")
+            self._layout = Layout.load(layout_file) if layout_file else get_layout()
+        return self._layout
+
+    # モデルのパスと出力名（<区画名>.jpg）の対応
+    @property
+    def models_and_outputs(self):
+        return {lot["model"]: f"{lot['name']}.jpg" for lot in self.lots}
+
+    # 出力名と Visitory の駐車場 ID の対応（ID が設定されている区画だけ）
+    @property
+    def parking_lot_ids(self):
+        parking_lot_ids = {}
+        for lot in self.lots:
+            if "visitory_id_env" in lot:
+                parking_lot_id = os.getenv(lot["visitory_id_env"])
+            else:
+                parking_lot_id = lot.get("visitory_id")
+            if parking_lot_id:
+                parking_lot_ids[f"{lot['name']}.jpg"] = parking_lot_id
+        return parking_lot_ids
+
+
+def load_sites(path):
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    sites = {}
+    lot_names = set()
+    for site_config in config["sites"]:
+        site = Site(site_config)
+        if site.name in sites:
+            raise ValueError(f"Site {site.name} is defined more than once")
+        for lot in site.lots:
+            if lot["name"] in lot_names:
+                raise ValueError(f"Lot {lot['name']} is defined in more than one site")
+            lot_names.add(lot["name"])
+        sites[site.name] = site
+    return sites
+
+
+_sites = None
+_sites_lock = threading.Lock()
+
+
+# 設定ファイル（環境変数 SITES_FILE、既定は config/sites.json）から全サイトを読み込む
+def get_sites():
+    global _sites
+    with _sites_lock:
+        if _sites is None:
+            _sites = load_sites(os.getenv("SITES_FILE", DEFAULT_SITES_FILE))
+        return _sites
+
+
+# 名前を指定しなければ設定ファイルの最初のサイトを返す
+def get_site(name=None):
+    sites = get_sites()
+    if name is None:
+        return next(iter(sites.values()))
+    if name not in sites:
+        raise KeyError(f"Site {name} is not defined")
+    return sites[name]
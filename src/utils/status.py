@@ -0,0 +1,17 @@
+# Visitory に送る駐車場の状態
+EMPTY = "1"
+FULL = "6"
+CROWDED = "5"
+
+# モデルの出力のクラス番号と名前（学習データのフォルダ名の順）
+CLASS_NAMES = ["crowded", "empty", "full"]
+
+
+# クラス番号を駐車場の状態に変換
+def to_status(pred):
+    if pred == 0:
+        return CROWDED
+    elif pred == 1:
+        return EMPTY
+    else:
+        return FULL
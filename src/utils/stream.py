@@ -0,0 +1,207 @@
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+
+# ライブ配信に1本だけ接続し続けてフレームをメモリ上に取り出すクラス
+# yt-dlp / streamlink で配信URLを解決し、ffmpeg で RGB の生フレームにデコードする
+# 接続が切れた場合は自動で再接続する
+class FrameSource:
+    def __init__(
+        self,
+        url,
+        backend="yt-dlp",
+        cookies="cookies.txt",
+        decode_fps=1.0,
+        reconnect_delay=5,
+        max_reconnect_delay=300,
+    ):
+        self.url = url
+        self.backend = backend
+        self.cookies = cookies
+        self.decode_fps = decode_fps
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self._process = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._condition = threading.Condition()
+        self._frame = None
+        self._frame_time = None
+        self._frame_count = 0
+        self.reconnects = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="frame-source", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        self._terminate()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        with self._condition:
+            self._condition.notify_all()
+
+    # 最新のフレームを返す（after より新しいフレームが届くまで待つ）
+    def read(self, timeout=None, after=0):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._frame_count <= after and not self._stopped.is_set():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None, None, self._frame_count
+                self._condition.wait(remaining)
+            return self._frame, self._frame_time, self._frame_count
+
+    # interval 秒ごとに (フレーム, 取得時刻) を返すジェネレータ
+    def frames(self, interval, timeout=None):
+        last_count = 0
+        next_tick = time.monotonic()
+        while not self._stopped.is_set():
+            frame, frame_time, last_count = self.read(timeout, after=last_count)
+            if self._stopped.is_set():
+                break
+            if frame is not None:
+                yield frame, frame_time
+
+            next_tick += interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self._stopped.wait(delay)
+            else:
+                # 処理が間隔より遅れた場合は次の周期に合わせ直す
+                next_tick = time.monotonic()
+
+    def _resolve(self):
+        if self.backend == "streamlink":
+            command = ["streamlink", "--stream-url", self.url, "best"]
+        else:
+            command = [
+                "yt-dlp",
+                "--cookies",
+                self.cookies,
+                "-g",
+                "-f",
+                "best[ext=mp4]",
+                self.url,
+            ]
+        output = subprocess.run(
+            command, check=True, capture_output=True, text=True, timeout=60
+        ).stdout
+        return output.strip().splitlines()[0]
+
+    def _probe(self, stream_url):
+        output = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "stream=width,height",
+                "-of",
+                "csv=p=0:s=x",
+                stream_url,
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+            timeout=60,
+        ).stdout
+        width, height = output.strip().splitlines()[0].split("x")
+        return int(width), int(height)
+
+    def _connect(self):
+        stream_url = self._resolve()
+        width, height = self._probe(stream_url)
+        process = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-loglevel",
+                "error",
+                "-i",
+                stream_url,
+                "-vf",
+                f"fps={self.decode_fps}",
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "rgb24",
+                "pipe:1",
+            ],
+            stdout=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
+        )
+        self._process = process
+        return process, width, height
+
+    def _terminate(self):
+        process = self._process
+        self._process = None
+        if process is not None and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def _read_exact(self, process, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        read = 0
+        while read < size:
+            n = process.stdout.readinto(view[read:])
+            if not n:
+                return None
+            read += n
+        return buffer
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while not self._stopped.is_set():
+            try:
+                process, width, height = self._connect()
+                print(f"ストリームに接続しました: {width}x{height}")
+                frame_size = width * height * 3
+                while not self._stopped.is_set():
+                    buffer = self._read_exact(process, frame_size)
+                    if buffer is None:
+                        break
+                    frame = np.frombuffer(buffer, dtype=np.uint8).reshape(
+                        height, width, 3
+                    )
+                    with self._condition:
+                        self._frame = frame
+                        self._frame_time = time.time()
+                        self._frame_count += 1
+                        self._condition.notify_all()
+                    delay = self.reconnect_delay
+            except (subprocess.SubprocessError, OSError, ValueError, IndexError) as e:
+                print(f"ストリームの取得でエラーが発生しました: {e}")
+            finally:
+                self._terminate()
+
+            if self._stopped.is_set():
+                break
+            self.reconnects += 1
+            print(f"{delay}秒後にストリームへ再接続します")
+            self._stopped.wait(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
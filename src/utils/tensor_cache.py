@@ -0,0 +1,118 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+from torchvision import datasets
+
+from utils.predict import MEAN, STD
+
+IMAGE_SIZE = 224
+
+
+# データセット（ImageFolder 形式）の画像を1回だけデコード・リサイズし、
+# uint8 の memmap 配列（N x 224 x 224 x 3）とラベルとして保存する
+# cache_dir/images.u8, cache_dir/labels.npy, cache_dir/index.json
+def build_cache(data_dir, cache_dir, num_threads=8):
+    folder = datasets.ImageFolder(data_dir)
+    samples = [os.path.relpath(path, data_dir) for path, _ in folder.samples]
+    index = {
+        "classes": folder.classes,
+        "count": len(samples),
+        "size": IMAGE_SIZE,
+        "samples": samples,
+    }
+
+    if _is_fresh(cache_dir, index):
+        return cache_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    images_path = os.path.join(cache_dir, "images.u8")
+    images = np.memmap(
+        images_path,
+        dtype=np.uint8,
+        mode="w+",
+        shape=(max(len(samples), 1), IMAGE_SIZE, IMAGE_SIZE, 3),
+    )
+
+    def decode(i):
+        path, _ = folder.samples[i]
+        with Image.open(path) as image:
+            image = image.convert("RGB").resize(
+                (IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR
+            )
+            images[i] = np.asarray(image)
+
+    # PIL のデコードとリサイズは GIL を解放するためスレッドで並列化できる
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(decode, range(len(samples))))
+    images.flush()
+    del images
+
+    labels = np.array([label for _, label in folder.samples], dtype=np.int64)
+    np.save(os.path.join(cache_dir, "labels.npy"), labels)
+
+    # index.json は最後に書き、途中で中断したキャッシュを使わないようにする
+    with open(os.path.join(cache_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    print(f"キャッシュを作成しました: {cache_dir} ({len(samples)}枚)")
+    return cache_dir
+
+
+def _is_fresh(cache_dir, index):
+    index_path = os.path.join(cache_dir, "index.json")
+    if not os.path.exists(index_path):
+        return False
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return cached == index
+
+
+# memmap のキャッシュから読み込む Dataset
+# デコードとリサイズは済んでいるため、左右反転（学習時）と正規化だけを行う
+class CachedImageDataset(Dataset):
+    def __init__(self, cache_dir, train=False):
+        self.cache_dir = cache_dir
+        self.train = train
+        with open(os.path.join(cache_dir, "index.json"), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.classes = index["classes"]
+        self.count = index["count"]
+        self.size = index["size"]
+        self.labels = np.load(os.path.join(cache_dir, "labels.npy"))
+        self.mean = torch.tensor(MEAN).view(3, 1, 1)
+        self.std = torch.tensor(STD).view(3, 1, 1)
+        # memmap は DataLoader のワーカーごとに開く
+        self._images = None
+
+    def __len__(self):
+        return self.count
+
+    def _open(self):
+        if self._images is None:
+            self._images = np.memmap(
+                os.path.join(self.cache_dir, "images.u8"),
+                dtype=np.uint8,
+                mode="r",
+                shape=(max(self.count, 1), self.size, self.size, 3),
+            )
+        return self._images
+
+    def __getitem__(self, i):
+        image = torch.from_numpy(np.array(self._open()[i]))
+        image = image.permute(2, 0, 1).float().div_(255)
+        if self.train and torch.rand(1).item() < 0.5:
+            image = image.flip(-1)
+        image = (image - self.mean) / self.std
+        return image, int(self.labels[i])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
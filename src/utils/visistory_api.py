@@ -1,63 +1,261 @@
 import requests
 import json
 import os
-from utils.predict import load_model, predict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.predict import predict_batch
+from utils.model_registry import registry
+from utils.history import record_results
+from utils.metrics import lot_name, metrics
+from utils.sites import get_site
 
 
-def run_predictions(segments):
+def run_predictions(
+    segments,
+    inference_server=None,
+    source=None,
+    change_detector=None,
+    parking_lot_ids=None,
+):
     results = {}
+
+    # 前回から変化のないセグメントは推論せずに前回の結果を使う
+    signatures = {}
+    if change_detector is not None:
+        pending = []
+        for segment in segments:
+            segment_image, _, output_name = segment
+            signature = change_detector.signature(segment_image)
+            status = change_detector.lookup(output_name, signature)
+            if status is None:
+                signatures[output_name] = signature
+                pending.append(segment)
+            else:
+                results[output_name] = status
+                metrics.inc("segments_skipped_total", lot=lot_name(output_name))
+        segments_to_predict = pending
+    else:
+        segments_to_predict = segments
+
+    try:
+        if not segments_to_predict:
+            pass
+        elif inference_server is not None and inference_server.running:
+            # 推論サーバーに渡し、他のリクエストとまとめてバッチ推論する
+            results.update(inference_server.submit(segments_to_predict).result())
+        else:
+            # 全セグメントを1バッチにまとめ、各モデルで一括推論する
+            # （モデルはプロセス共有のレジストリから取得、起動時にロード済み）
+            # 変化した区画だけを推論する場合も、全区画のモデルのアンサンブルを使い回す
+            ensemble, device = registry.get_ensemble(
+                [model_path for _, model_path, _ in segments_to_predict],
+                model_set=[model_path for _, model_path, _ in segments],
+            )
+            statuses = predict_batch(
+                [segment for segment, _, _ in segments_to_predict], ensemble, device
+            )
+            for (_, _, output_name), status in zip(segments_to_predict, statuses):
+                results[output_name] = status
+    except Exception as e:
+        raise Exception(f"Error running batched prediction: {e}")
+
+    if change_detector is not None:
+        for output_name, signature in signatures.items():
+            change_detector.update(output_name, signature, results[output_name])
+        change_detector.save_state()
+        print(f"変化検出: {change_detector.stats()}")
+
+    for output_name, status in results.items():
+        metrics.inc("predictions_total", lot=lot_name(output_name), status=status)
+
+    # 予測結果を履歴に残す
+    record_results(results, source=source)
+
+    # 全ての予測が終わってから、まとめて送信
+    send_results(results, parking_lot_ids)
+
+    return results
+
+
+# 予測結果のうち、駐車場のIDが設定されているものをセンサーの状態として送信
+# parking_lot_ids（出力名 -> ID）を省略した場合は既定のサイトの設定を使う
+def send_results(results, parking_lot_ids=None):
     visitory_url = os.getenv("VISITORY_URL")
     visitory_headers = {
         "Authorization": os.getenv("VISITORY_AUTH"),
         "Content-Type": "application/json",
     }
-    parking_lot_ids = {
-        "takeda_a.jpg": os.getenv("PARKING_LOT_TAKEDA_A"),
-        "takeda_b.jpg": os.getenv("PARKING_LOT_TAKEDA_B"),
-        "takeda_c.jpg": os.getenv("PARKING_LOT_TAKEDA_C"),
-        "takeda_d.jpg": os.getenv("PARKING_LOT_TAKEDA_D"),
-        "rittai_p.jpg": os.getenv("PARKING_LOT_RITTAI_P"),
+    if parking_lot_ids is None:
+        parking_lot_ids = get_site().parking_lot_ids
+
+    statuses = {
+        parking_lot_ids[output_name]: status
+        for output_name, status in results.items()
+        if parking_lot_ids.get(output_name) is not None
     }
+    if not statuses:
+        return {}
+    return get_visitory_client(visitory_url, visitory_headers).send_all(statuses)
 
-    # モデルのキャッシュ
-    model_cache = {}
 
-    for segment_path, model_path, output_name in segments:
-        # モデルのロード（キャッシュして再利用）
-        if model_path not in model_cache:
-            model, device = load_model(model_path)
-            model_cache[model_path] = (model, device)
-        else:
-            model, device = model_cache[model_path]
+# Visitory API クライアント
+# keep-alive のセッションを使い回し、状態が変わった駐車場だけを並列に送信する
+# 最後の送信から resend_after 秒が過ぎた駐車場は、状態が同じでも送り直す
+# （Visitory 側の状態が手動の編集やリセットで食い違っても、その時間内に正しい状態に戻る）
+class VisitoryClient:
+    def __init__(
+        self,
+        url,
+        headers,
+        max_workers=5,
+        retries=3,
+        backoff_factor=0.5,
+        timeout=10,
+        state_path=None,
+        resend_after=None,
+    ):
+        self.url = url
+        self.headers = headers
+        self.timeout = timeout
+        self.state_path = state_path
+        self.resend_after = resend_after
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        # parking_lot_id -> {"status": 最後に送信に成功した状態, "sent_at": 送信時刻}
+        # （cron で毎回起動する場合にも使えるよう state_path があればファイルに保存する）
+        self._last_sent = self._load_state()
 
-        # 画像の予測を実行
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
         try:
-            result = predict(segment_path, model, device)
-            results[output_name] = result
-        except Exception as e:
-            raise Exception(f"Error running prediction for {output_name}: {e}")
-
-        # 駐車場のIDが設定されている場合、センサーの状態を更新
-        if parking_lot_ids.get(output_name) is not None:
-            update_sensor_status(
-                visitory_url,
-                visitory_headers,
-                parking_lot_ids[output_name],
-                results[output_name],
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # 送信時刻のない以前の形式（parking_lot_id -> 状態）は、次回に送り直す
+        return {
+            parking_lot_id: (
+                entry if isinstance(entry, dict) else {"status": entry, "sent_at": 0}
             )
+            for parking_lot_id, entry in state.items()
+        }
 
-    return results
+    def _save_state(self):
+        if not self.state_path:
+            return
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._last_sent, f)
+        os.replace(tmp_path, self.state_path)
 
+    # 送信済みの状態を消す（次回は全駐車場を送信する）
+    def reset(self):
+        with self._lock:
+            self._last_sent.clear()
 
-def update_sensor_status(visitory_url, headers, parking_lot_id, status):
+    # 状態が変わった、または最後の送信から resend_after 秒以上経った駐車場か
+    def _needs_send(self, parking_lot_id, status, now):
+        last = self._last_sent.get(parking_lot_id)
+        if last is None or last["status"] != status:
+            return True
+        return bool(self.resend_after) and now - last["sent_at"] >= self.resend_after
+
+    def send_all(self, statuses):
+        now = time.time()
+        with self._lock:
+            changed = {
+                parking_lot_id: status
+                for parking_lot_id, status in statuses.items()
+                if self._needs_send(parking_lot_id, status, now)
+            }
+
+        futures = {
+            parking_lot_id: self._executor.submit(
+                update_sensor_status,
+                self.url,
+                self.headers,
+                parking_lot_id,
+                status,
+                session=self.session,
+                timeout=self.timeout,
+            )
+            for parking_lot_id, status in changed.items()
+        }
+
+        errors = []
+        for parking_lot_id, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(str(e))
+                continue
+            with self._lock:
+                self._last_sent[parking_lot_id] = {
+                    "status": changed[parking_lot_id],
+                    "sent_at": now,
+                }
+
+        if futures:
+            with self._lock:
+                self._save_state()
+
+        if errors:
+            raise Exception("; ".join(errors))
+        return changed
+
+
+_visitory_client = None
+_visitory_client_lock = threading.Lock()
+
+
+def get_visitory_client(visitory_url, headers):
+    global _visitory_client
+    with _visitory_client_lock:
+        if (
+            _visitory_client is None
+            or _visitory_client.url != visitory_url
+            or _visitory_client.headers != headers
+        ):
+            _visitory_client = VisitoryClient(
+                visitory_url,
+                headers,
+                state_path=os.getenv("VISITORY_STATE_FILE"),
+                resend_after=float(os.getenv("VISITORY_RESEND_SECONDS", "900")),
+            )
+        return _visitory_client
+
+
+def update_sensor_status(
+    visitory_url, headers, parking_lot_id, status, session=None, timeout=None
+):
     body = {
         "id": parking_lot_id,
         "value": status,
     }
 
-    response = requests.post(visitory_url, headers=headers, data=json.dumps(body))
-
-    if response.status_code != 200:
-        raise Exception(
-            f"Failed to update sensor: {response.status_code}, {response.text}"
+    post = session.post if session is not None else requests.post
+    with metrics.timer("send", sensor=parking_lot_id):
+        response = post(
+            visitory_url, headers=headers, data=json.dumps(body), timeout=timeout
         )
+
+        if response.status_code != 200:
+            raise Exception(
+                f"Failed to update sensor: {response.status_code}, {response.text}"
+            )